@@ -0,0 +1,109 @@
+"""Static files of the pages: fingerprinted names and precompressed copies.
+
+When the worker starts, every asset gets a name with a hash of its content (styles.1b86d0c6a3.css)
+and gzip (and brotli, if the brotli package is installed) copies are made once.
+Pages reference the hashed names, so the files can be cached by browsers forever (Cache-Control: immutable)
+and a changed file simply gets a new name.
+
+The same files can be written to a directory, e.g. to be served by nginx:
+    python assets.py build /var/www/bitlinks/assets"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#Files referenced by the pages
+ASSETS = ('styles.css', 'clipboard.min.js', 'favicon.png', 'favicon.ico')
+
+#Types that are worth compressing
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Asset:
+    """One static file with its hashed name and its compressed variants {encoding: bytes}."""
+
+    def __init__(self, name, content):
+        self.name = name
+        self.hash = hashlib.md5(content).hexdigest()[:10]
+        base, extension = os.path.splitext(name)
+        self.hashed_name = '%s.%s%s' % (base, self.hash, extension)
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.variants = {'identity': content}
+        if is_compressible(self.content_type):
+            self.variants['gzip'] = gzip.compress(content, 9)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(content)
+
+    def negotiate(self, accept_encoding):
+        """Return (encoding, bytes) of the smallest variant the client accepts."""
+
+        accepted = parse_accept_encoding(accept_encoding)
+        encoding = min((encoding for encoding in self.variants if encoding in accepted),
+                       key=lambda encoding: len(self.variants[encoding]))
+        return encoding, self.variants[encoding]
+
+
+class Assets:
+    """All assets of the pages, loaded and compressed once."""
+
+    def __init__(self, root, names=ASSETS, url_prefix='/bitlinks/assets/'):
+        self.url_prefix = url_prefix
+        self.by_name = {}
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as in_stream:
+                self.by_name[name] = Asset(name, in_stream.read())
+        self.by_hashed_name = {asset.hashed_name: asset for asset in self.by_name.values()}
+
+    def url(self, name):
+        """URL of the asset with the hashed name."""
+
+        return self.url_prefix + self.by_name[name].hashed_name
+
+    def get(self, hashed_name):
+        """The asset with this hashed name or None."""
+
+        return self.by_hashed_name.get(hashed_name)
+
+    def build(self, directory):
+        """Write hashed files and their .gz / .br copies to the directory."""
+
+        os.makedirs(directory, exist_ok=True)
+        extensions = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for asset in self.by_name.values():
+            for encoding, content in asset.variants.items():
+                with open(os.path.join(directory, asset.hashed_name + extensions[encoding]), 'wb') as out_stream:
+                    out_stream.write(content)
+
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def parse_accept_encoding(header):
+    """Encodings accepted by the client (q=0 means 'not accepted'). Identity is always accepted."""
+
+    accepted = {'identity'}
+    for item in (header or '').split(','):
+        encoding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        if encoding:
+            accepted.add(encoding.strip().lower())
+    return accepted
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != 'build':
+        sys.exit('Usage: python assets.py build /path/to/directory')
+    assets = Assets(os.path.dirname(os.path.abspath(__file__)))
+    assets.build(sys.argv[2])
+    for asset in assets.by_name.values():
+        print('%s -> %s (%s)' % (asset.name, asset.hashed_name, ', '.join(
+            '%s: %d' % (encoding, len(content)) for encoding, content in asset.variants.items())))
@@ -0,0 +1,255 @@
+"""Micro-benchmark of cache lookups as the cache grows.
+
+Builds synthetic caches of every size (1k ... 10M URLs, 3 channels each) for every backend
+and measures the startup (opening the cache), hit and miss lookups and appends of new entries:
+
+    python bench_cache.py --output cache-bench.json
+    python bench_cache.py --sizes 1000,100000 --backends file,sqlite --baseline cache-bench.json
+
+Backends:
+    scan   - the original lookup: cache.txt is read line by line on every request (a baseline, see --scan-max);
+    file   - CacheIndex, the sorted index of cache.txt mapped into memory and a dict of the recent entries,
+             appends are written behind in batches (the first open makes the index, see reopen_us;
+             `written` is the delay until an append is on disk, up to CACHE_FLUSH_INTERVAL);
+    sqlite - SqliteCache, the WAL database.
+
+Results are written as JSON (one record per backend and size, times in microseconds).
+Every operation is run once over its samples to warm up, then --repeats times; the median pass is reported.
+With --baseline, the p50 times are compared with a previous run and the exit code is 1
+if any of them is slower than --tolerance times the baseline and by more than --floor microseconds,
+so regressions are caught before deploy.
+The 10M caches take a few GB of disk and, for the file backend, of memory."""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from cache import CacheIndex, SqliteCache
+
+CHANNELS = ('telegram', 'vk', 'instagram')
+
+
+class LinearScan:
+    """The cache lookup as it was before the index: the whole file is read until the URL is found."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, url):
+        bitlinks = {}
+        with open(self.path) as in_stream:
+            for line in in_stream:
+                new_line = line.strip().split('\t')
+                if new_line[0] == url:
+                    bitlinks[new_line[1]] = new_line[2]
+                elif bitlinks:
+                    #The lines of one entry are written together
+                    break
+        return bitlinks or None
+
+    def add(self, url, bitlinks, written=None):
+        with open(self.path, 'a') as out_stream:
+            out_stream.write(''.join(url + '\t' + channel + '\t' + bitlink + '\n' for channel, bitlink in bitlinks.items()))
+        if written is not None:
+            written()
+
+    def close(self):
+        pass
+
+
+def synthetic_url(number):
+    return 'https://subdomain.domain.ru/category/page-name-some-id-%d?utm_content=%08x' % (number, number * 2654435761 % 2 ** 32)
+
+
+def synthetic_bitlinks(number):
+    return {channel: 'http://bit.ly/%07x' % ((number * 3 + index) % 16 ** 7) for index, channel in enumerate(CHANNELS)}
+
+
+def build_file(path, size):
+    """Write a cache.txt with `size` URLs in the current format (one line per channel)."""
+
+    with open(path, 'w') as out_stream:
+        for start in range(0, size, 10000):
+            out_stream.write(''.join(
+                synthetic_url(number) + '\t' + channel + '\t' + bitlink + '\n'
+                for number in range(start, min(size, start + 10000))
+                for channel, bitlink in synthetic_bitlinks(number).items()
+            ))
+
+
+def build_db(path, size):
+    """Write a cache.db with `size` URLs."""
+
+    store = SqliteCache(path)
+    for start in range(0, size, 10000):
+        store.add_many((synthetic_url(number), synthetic_bitlinks(number)) for number in range(start, min(size, start + 10000)))
+
+
+def run(calls):
+    """Run the calls and return their mean, p50 and p99 in microseconds."""
+
+    elapsed = []
+    for call in calls:
+        started = time.perf_counter()
+        call()
+        elapsed.append((time.perf_counter() - started) * 1e6)
+    return summary(elapsed)
+
+
+def summary(elapsed):
+    """Mean, p50 and p99 of times in microseconds."""
+
+    elapsed = sorted(elapsed)
+    return {
+        'mean_us': sum(elapsed) / len(elapsed),
+        'p50_us': elapsed[len(elapsed) // 2],
+        'p99_us': elapsed[min(len(elapsed) - 1, int(len(elapsed) * 0.99))],
+    }
+
+
+def timings(calls, repeats):
+    """Run the calls of every pass (calls(number) - a list) once to warm up the caches, then `repeats` times.
+    Returns the median over the repeats of their mean, p50 and p99 in microseconds, so one noisy pass does not count."""
+
+    run(calls(0))
+    passes = [run(calls(number)) for number in range(1, repeats + 1)]
+    return {name: round(sorted(result[name] for result in passes)[len(passes) // 2], 2) for name in passes[0]}
+
+
+def bench(backend, size, samples, repeats, directory, seed):
+    """Build a cache of the size for the backend and measure it. Returns a result record."""
+
+    rng = random.Random(seed)
+    path = os.path.join(directory, 'cache-%d.%s' % (size, 'db' if backend == 'sqlite' else 'txt'))
+
+    started = time.perf_counter()
+    if backend == 'sqlite':
+        build_db(path, size)
+    else:
+        build_file(path, size)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    store = {'scan': LinearScan, 'file': CacheIndex, 'sqlite': SqliteCache}[backend](path)
+    open_us = (time.perf_counter() - started) * 1e6
+
+    #Startup of another worker, with the files as the first one left them
+    started = time.perf_counter()
+    {'scan': LinearScan, 'file': CacheIndex, 'sqlite': SqliteCache}[backend](path).close()
+    reopen_us = (time.perf_counter() - started) * 1e6
+
+    hits = [synthetic_url(rng.randrange(size)) for _ in range(samples)]
+    misses = [synthetic_url(size + rng.randrange(size)) for _ in range(samples)]
+    #Every pass appends new URLs, the way a request does: the entry is buffered and the single-flight lock
+    #is released by the written() callback, once it is on disk (delays in `written`)
+    new = lambda number: [size + 10 ** 9 + number * samples + sample for sample in range(samples)]
+    written = []
+
+    def add(number):
+        started = time.perf_counter()
+        store.add(synthetic_url(number), synthetic_bitlinks(number),
+                  lambda: written.append((time.perf_counter() - started) * 1e6))
+
+    record = {
+        'backend': backend,
+        'size': size,
+        'samples': samples,
+        'repeats': repeats,
+        'build_s': round(build_seconds, 2),
+        'bytes': os.path.getsize(path),
+        'open_us': round(open_us, 2),
+        'reopen_us': round(reopen_us, 2),
+        'hit': timings(lambda _: [lambda url=url: store.get(url) for url in hits], repeats),
+        'miss': timings(lambda _: [lambda url=url: store.get(url) for url in misses], repeats),
+        'append': timings(lambda number: [lambda new_number=new_number: add(new_number) for new_number in new(number)],
+                          repeats),
+    }
+    deadline = time.monotonic() + 60
+    while len(written) < (repeats + 1) * samples and time.monotonic() < deadline:
+        time.sleep(0.01)
+    if len(written) < (repeats + 1) * samples:
+        raise RuntimeError('%s cache of %d URLs did not write its appends' % (backend, size))
+    record['written'] = {name: round(value, 2) for name, value in summary(written).items()}
+
+    #Appended entries must be found: a benchmark of a broken cache is worthless
+    if store.get(synthetic_url(new(repeats)[-1])) is None or store.get(hits[0]) is None:
+        raise RuntimeError('%s cache of %d URLs does not find its entries' % (backend, size))
+    store.close()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    return record
+
+
+def regressions(results, baseline, tolerance, floor):
+    """Lines describing the p50 times that are slower than tolerance times the baseline and by more than floor microseconds
+    (lookups of a few microseconds vary by more than the tolerance from run to run)."""
+
+    previous = {(record['backend'], record['size']): record for record in baseline}
+    found = []
+    for record in results:
+        old = previous.get((record['backend'], record['size']))
+        if old is None:
+            continue
+        for operation in ('hit', 'miss', 'append'):
+            p50, old_p50 = record[operation]['p50_us'], old[operation]['p50_us']
+            if p50 > old_p50 * tolerance and p50 - old_p50 > floor:
+                found.append('%s %d %s: p50 %.2f us, was %.2f us' % (
+                    record['backend'], record['size'], operation, p50, old_p50))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of cache lookups by cache size.')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000,10000000', help='comma-separated numbers of URLs')
+    parser.add_argument('--backends', default='scan,file,sqlite', help='comma-separated backends: scan, file, sqlite')
+    parser.add_argument('--samples', type=int, default=1000, help='lookups and appends measured per backend and size')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='measured passes over the samples after a warm-up pass, the median pass is reported')
+    parser.add_argument('--scan-max', type=int, default=100000,
+                        help='largest cache for the scan baseline (it reads the whole file per lookup)')
+    parser.add_argument('--scan-samples', type=int, default=50, help='lookups and appends measured for the scan baseline')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the sampled URLs')
+    parser.add_argument('--output', help='write the results (JSON) to this file')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown against the baseline')
+    parser.add_argument('--floor', type=float, default=5, help='slowdowns of fewer microseconds are never regressions')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bitlinks-bench-')
+    results = []
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            for backend in args.backends.split(','):
+                if backend == 'scan' and size > args.scan_max:
+                    continue
+                samples = args.scan_samples if backend == 'scan' else args.samples
+                record = bench(backend, size, samples, args.repeats, directory, args.seed)
+                results.append(record)
+                print('%-6s %9d URLs: open %10.0f us, reopen %8.0f us, hit p50 %9.2f us, miss p50 %9.2f us, '
+                      'append p50 %9.2f us, written p50 %9.0f us' % (
+                    backend, size, record['open_us'], record['reopen_us'], record['hit']['p50_us'], record['miss']['p50_us'],
+                    record['append']['p50_us'], record['written']['p50_us']))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as out_stream:
+            json.dump(results, out_stream, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as in_stream:
+            found = regressions(results, json.load(in_stream), args.tolerance, args.floor)
+        for line in found:
+            print('Regression: ' + line, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
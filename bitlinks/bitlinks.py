@@ -33,14 +33,124 @@ Example:
 
 Service available here: http://35.156.199.247/bitlinks"""
 
-from urllib.request import urlopen
-import urllib.error
-from multiprocessing.dummy import Pool as ThreadPool
-from flask import Flask, request, make_response, jsonify
-import bitly_api
+import gzip
+import hashlib
+import json
+import queue
+import time
+from concurrent.futures import as_completed
+from flask import Flask, Response, abort, g, request, make_response, jsonify, render_template
+from markupsafe import Markup
+from assets import Assets, parse_accept_encoding
+from bitly_client import BitlyClient, SHORTEN_ERRORS
+from cache import open_cache, TTLCache
+from executor import Executor, Busy, at_shutdown
+from governor import Governor
+from metrics import Registry
+from normalize import normalize_url, add_query
+from retry import BackgroundRetry
+from singleflight import SingleFlight
+from timing import measure
+import timing
+from validator import PageValidator
+import settings
 
 app = Flask(__name__)
 
+#Static files of the pages with hashed names and precompressed copies, made once per worker
+assets = Assets(app.root_path)
+
+#Page templates (templates/) are compiled once, when the worker starts
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+app.jinja_env.globals.update(asset_url=assets.url, channels=settings.CHANNELS)
+#A hash of the templates and assets is part of the ETag of result pages, so a new release changes the ETags
+pages_version = hashlib.md5(''.join(sorted(asset.hash for asset in assets.by_name.values())).encode('utf-8'))
+for template in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template)
+    pages_version.update(app.jinja_env.loader.get_source(app.jinja_env, template)[0].encode('utf-8'))
+pages_version = pages_version.hexdigest()
+
+def canonical_url(url):
+    """Function to get the canonical form of the requested URL - the one key used everywhere."""
+
+    return normalize_url(url, settings.TRACKING_PARAMS, settings.TRACKING_PREFIXES, settings.STRIP_TRAILING_SLASH)
+
+
+#Cache store, opened once per worker (see CACHE_BACKEND in settings.py).
+#The file backend writes new bitlinks in the background, what is still buffered is written when the worker stops
+cache = open_cache(settings.CACHE_BACKEND, settings.CACHE_FILE, settings.CACHE_DB,
+                   flush_entries=settings.CACHE_FLUSH_ENTRIES, flush_interval=settings.CACHE_FLUSH_INTERVAL,
+                   segment_size=settings.CACHE_SEGMENT_SIZE, compact_interval=settings.CACHE_COMPACT_INTERVAL,
+                   canonical=canonical_url)
+at_shutdown(cache.close)
+
+#Recently rejected URLs with the reason, kept apart from the cache and expiring on their own
+rejected = TTLCache(settings.NEGATIVE_TTL, settings.NEGATIVE_MAXSIZE)
+
+#Coalescing of concurrent shortening requests for the same URL
+single_flight = SingleFlight(settings.LOCK_DIR)
+
+#Thread pool shared by all requests of the worker, stopped on uwsgi reload (see below)
+executor = Executor(settings.EXECUTOR_WORKERS, settings.EXECUTOR_MAX_QUEUE)
+
+#Separate pool for the items of batch requests: they wait on the shared pool, so they must not take its threads
+batch_executor = Executor(settings.BATCH_CONCURRENCY, settings.BATCH_MAX_QUEUE)
+
+#Separate pool for the streamed /bitlinks/nojs pages, which wait on the shared pool in the same way
+stream_executor = Executor(settings.STREAM_CONCURRENCY, settings.STREAM_MAX_QUEUE)
+
+#Bitly client with a pool of kept-alive connections, shared by the threads of the worker,
+#behind the governor: rate limit, retries and circuit breaker shared by all workers
+bitly = Governor(BitlyClient(settings.BITLY_TOKEN, settings.BITLY_API, settings.EXECUTOR_WORKERS,
+                             settings.BITLY_CONNECT_TIMEOUT, settings.BITLY_READ_TIMEOUT),
+                 settings.BITLY_STATE, settings.BITLY_RATE, settings.BITLY_BURST, settings.BITLY_ATTEMPTS,
+                 settings.BITLY_BACKOFF, settings.BITLY_MAX_WAIT, settings.BITLY_BREAKER_FAILURES,
+                 settings.BITLY_BREAKER_COOLDOWN)
+at_shutdown(bitly.close)
+
+#Checking that requested pages exist: HEAD with a deadline, kept-alive connections, results remembered for a while
+validator = PageValidator(settings.VALIDATOR_DEADLINE, settings.VALIDATOR_CONNECT_TIMEOUT, settings.EXECUTOR_WORKERS,
+                          settings.VALIDATOR_TTL, settings.VALIDATOR_MAXSIZE)
+at_shutdown(validator.close)
+
+#Shutdown hooks run in reverse order: the pools are drained before Bitly, the validator and the cache are closed,
+#since their tasks in flight still use them. Streamed pages and batch items wait on the shared pool, so they go first
+at_shutdown(executor.shutdown)
+at_shutdown(batch_executor.shutdown)
+at_shutdown(stream_executor.shutdown)
+
+#Metrics of the worker, summed over all workers by /bitlinks/metrics
+registry = Registry(settings.METRICS_DIR, settings.METRICS_INTERVAL)
+at_shutdown(registry.stop)
+request_count = registry.counter('bitlinks_requests_total', 'Requests by route and status code', ('route', 'status'))
+request_seconds = registry.histogram('bitlinks_request_seconds',
+                                     'Time to the response (to the first byte of streamed pages) by route', ('route',))
+cache_lookups = registry.counter('bitlinks_cache_lookups_total', 'Cache lookups of requested URLs by result', ('result',))
+status_seconds = registry.histogram('bitlinks_status_check_seconds',
+                                    'Time to check that a requested page exists, by outcome (status code)', ('outcome',))
+bitly_seconds = registry.histogram('bitlinks_bitly_seconds', 'Time of Bitly shortenings by channel and outcome',
+                                   ('channel', 'outcome'))
+bitly_errors = registry.counter('bitlinks_bitly_errors_total', 'Failed Bitly shortenings by channel and error',
+                                ('channel', 'error'))
+pools = {'shared': executor, 'batch': batch_executor, 'stream': stream_executor}
+registry.gauge('bitlinks_pool_tasks', 'Tasks in the thread pools by pool and state (active or queued)', ('pool', 'state'),
+               lambda: {(name, state): pool.stats()[state] for name, pool in pools.items() for state in ('active', 'queued')})
+registry.gauge('bitlinks_pool_threads', 'Threads of the thread pools', ('pool',),
+               lambda: {(name,): pool.workers for name, pool in pools.items()})
+registry.gauge('bitlinks_retry_pending', 'URLs waiting for a background retry of their channels', (),
+               lambda: {(): retry.pending()})
+retry_count = registry.counter('bitlinks_retries_total',
+                               'Background retries of missing channels by outcome (done, failed, given_up)', ('outcome',))
+
+#Channels whose shortening failed are made again in the background and added to the cache entry
+retry = BackgroundRetry(executor, settings.RETRY_DELAY, settings.RETRY_ATTEMPTS, retry_count)
+at_shutdown(retry.stop)
+
+#Shown in place of a bitlink that is still being made in the background, and while Bitly is failing
+PENDING = 'Not ready yet: open the link again in a minute'
+BITLY_DOWN = 'Bitly is not available now: the link will be made when it is back'
+
 
 @app.route("/bitlinks")
 def home():
@@ -50,184 +160,149 @@ def home():
     Default form action (/bitlinks/go) for users with enabled JavaScript.
     Hidden submit with <noscript> tag for users with disabled JavaScript."""
 
-    resp = make_response('''<!DOCTYPE html>
-<html lang="en">
-
-<head>
-    <meta charset="UTF-8">
-    <title>Link to Bitlinks with UTM</title>
-    <meta name="description" content="Web service for automatic processing of URLs and generating bitlinks.">
-    <link rel="icon" type="image/png" href="/bitlinks/favicon.png">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        html {
-            height: 100%;
-            background: #092756
-        }
-        
-        #feedback-page {
-            text-align: center
-        }
-        
-        #form-main {
-            width: 100%;
-            float: left;
-            padding-top: 0
-        }
-        
-        #form-div {
-            background-color: rgba(72, 72, 72, .4);
-            width: 450px;
-            float: left;
-            left: 50%;
-            position: absolute;
-            margin-top: 190px;
-            margin-left: -260px;
-            -moz-border-radius: 7px;
-            -webkit-border-radius: 7px;
-            padding: 35px 35px 50px
-        }
-        
-        .feedback-input {
-            color: #3c3c3c;
-            font-family: Helvetica, Arial, sans-serif;
-            font-weight: 500;
-            font-size: 18px;
-            border-radius: 0;
-            line-height: 22px;
-            background-color: #fbfbfb;
-            padding: 13px 13px 13px 54px;
-            margin-bottom: 10px;
-            width: 100%;
-            -webkit-box-sizing: border-box;
-            -moz-box-sizing: border-box;
-            -ms-box-sizing: border-box;
-            box-sizing: border-box;
-            border: 3px solid transparent
-        }
-        
-        .feedback-input:focus {
-            background: #fff;
-            box-shadow: 0;
-            border: 3px solid #3498db;
-            color: #3498db;
-            outline: 0;
-            padding: 13px 13px 13px 54px
-        }
-        
-        #instagram,
-        #instagram:focus,
-        #link,
-        #link:focus,
-        #telegram,
-        #telegram:focus,
-        #vk,
-        #vk:focus {
-            background-size: 30px 30px;
-            background-position: 11px 8px;
-            background-repeat: no-repeat
-        }
-        
-        .focused {
-            color: #30aed6;
-            border: 3px solid #30aed6
-        }
-        
-        textarea {
-            width: 100%;
-            height: 150px;
-            line-height: 150%;
-            resize: vertical
-        }
-        
-        input:focus,
-        input:hover,
-        textarea:focus,
-        textarea:hover {
-            background-color: #fff
-        }
-        
-        .btn {
-            font-family: Montserrat, Arial, Helvetica, sans-serif;
-            float: left;
-            width: 100%;
-            border: 4px solid #fbfbfb;
-            cursor: pointer;
-            background-color: #3498db;
-            color: #fff;
-            font-size: 24px;
-            padding-top: 22px;
-            padding-bottom: 22px;
-            -webkit-appearance: none;
-            -webkit-transition: all .3s;
-            -moz-transition: all .3s;
-            transition: all .3s;
-            margin-top: -4px;
-            font-weight: 700
-        }
-        
-        .btn:hover {
-            background-color: #fbfbfb;
-            color: #0493bd
-        }
-        
-        .submit:hover {
-            color: #3498db
-        }
-        
-        #button-blue-nojs {
-            margin-top: 10px
-        }
-        
-        @media only screen and (max-width:580px) {
-            #form-div {
-                left: 3%;
-                margin-right: 3%;
-                margin-top: 30px;
-                width: 88%;
-                margin-left: 0;
-                padding-left: 3%;
-                padding-right: 3%
-            }
-        }
-    </style>
-</head>
-
-<body>
-    <div id="form-main">
-        <div id="form-div">
-            <form class="form" id="form1" action="/bitlinks/go" method="GET">
-                <p>
-                    <input required name="url" type="url" class="feedback-input" placeholder="e.g. https://yandex.ru" id="link" /> </p>
-                <div class="submit">
-                    <input type="submit" value="Give Me Bitlinks" class="btn" id="button-blue" />
-                    <noscript>
-                        <input formaction="/bitlinks/nojs" type="submit" value="AND paranoid_mode = TRUE" class="btn" id="button-blue-nojs">
-                    </noscript>
-                </div>
-            </form>
-        </div>
-    </div>
-    <link rel="stylesheet" type="text/css" href="/bitlinks/styles.css">
-</body>
-
-</html>''')
+    resp = make_response(render_template('home.html'))
+
+    return resp
+
+
+def cached_bitlinks(url, counted=True):
+    """Function to get bitlinks of all channels from the cache, or None if any of them is missing.
+    The lookup is counted as a hit or a miss unless counted is False (repeated lookups of the same request)."""
+
+    with measure('cache'):
+        bitlinks = cache.get(url)
+    if bitlinks and all(channel in bitlinks for channel in settings.CHANNELS):
+        if counted:
+            cache_lookups.inc('hit')
+        return bitlinks
+    if counted:
+        cache_lookups.inc('miss')
+    return None
+
+
+def pending_text():
+    """Function to get the text shown in place of a bitlink that is not made yet."""
+
+    return BITLY_DOWN if bitly.is_open() else PENDING
+
+
+def channel_json(bitlinks, pending=PENDING):
+    """Function to name the bitlinks {channel: bitlink} the way the JSON answers do: {"bitlink_<channel>": bitlink}.
+    Channels that are still being made get the pending value."""
+
+    return {'bitlink_' + channel: bitlinks.get(channel, pending) for channel in settings.CHANNELS}
+
+
+@app.route("/bitlinks/assets/<name>")
+def asset(name):
+    """Function to serve a static file by its hashed name, compressed as the browser allows, cached forever."""
+
+    found = assets.get(name)
+    if found is None:
+        abort(404)
+
+    encoding, content = found.negotiate(request.headers.get('Accept-Encoding'))
+    resp = make_response(content)
+    resp.headers['Content-Type'] = found.content_type
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    resp.headers['ETag'] = '"%s"' % found.hash
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+
+    return resp
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    g.timings = timing.start(settings.SERVER_TIMING, settings.TIMING_LOG_SAMPLE)
+
+
+@app.teardown_request
+def stop_timer(error=None):
+    timing.stop()
+
+
+@app.after_request
+def server_timing(resp):
+    """Function to send the timings of the request phases in the Server-Timing header
+    and to log them for sampled requests once the response is sent (streamed pages included)."""
+
+    timings = g.get('timings')
+    if timings is None:
+        return resp
+
+    if settings.SERVER_TIMING:
+        resp.headers['Server-Timing'] = timings.header()
+    if timings.logged:
+        fields = dict(method=request.method, route=request.url_rule.rule if request.url_rule else 'other',
+                      status=resp.status_code, url=request.values.get('url'))
+        resp.call_on_close(lambda: timings.log(**fields))
+
+    return resp
+
+
+@app.after_request
+def count_request(resp):
+    """Function to count the request and its latency in the metrics."""
+
+    route = request.url_rule.rule if request.url_rule else 'other'
+    request_count.inc(route, str(resp.status_code))
+    request_seconds.observe(time.perf_counter() - g.started, route)
 
     return resp
 
-HTML_ESCAPE_TABLE = {
-    "&": "&amp;",
-    '"': "&quot;",
-    "'": "&apos;",
-    ">": "&gt;",
-    "<": "&lt;",
-}
 
+@app.after_request
+def compress(resp):
+    """Function to gzip pages and JSON answers for browsers that accept it."""
 
-def html_escape(text):
-    """Function for escaping characters to prevent XSS."""
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code != 200 or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in ('text/html', 'application/json')):
+        return resp
+
+    resp.headers.add('Vary', 'Accept-Encoding')
+    content = resp.get_data()
+    if len(content) < settings.GZIP_MIN_SIZE or 'gzip' not in parse_accept_encoding(request.headers.get('Accept-Encoding')):
+        return resp
 
-    return "".join(HTML_ESCAPE_TABLE.get(c, c) for c in text)
+    with measure('gzip'):
+        resp.set_data(gzip.compress(content, settings.GZIP_LEVEL))
+    resp.headers['Content-Encoding'] = 'gzip'
+
+    #A strong ETag must differ between the plain and the compressed page
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag + '-gzip')
+
+    return resp
+
+
+def result_page(url, bitlinks, copy_buttons=False):
+    """Function to answer with a page of cached bitlinks.
+    The page changes only with the cache entry, so it gets a strong ETag derived from the entry
+    and a browser that already has it gets 304 Not Modified without a body."""
+
+    entry = json.dumps([pages_version, copy_buttons, url, [(channel, bitlinks[channel]) for channel in settings.CHANNELS]])
+    etag = hashlib.sha1(entry.encode('utf-8')).hexdigest()
+    cache_control = 'public, max-age=%d' % settings.RESULT_MAX_AGE
+
+    #The compressed page has its own ETag (see compress), both mean the browser has this entry
+    for known in (etag, etag + '-gzip'):
+        if request.if_none_match.contains(known):
+            resp = make_response('', 304)
+            resp.set_etag(known)
+            resp.headers['Cache-Control'] = cache_control
+            resp.headers['Vary'] = 'Accept-Encoding'
+            return resp
+
+    with measure('render'):
+        resp = make_response(render_template('result.html', url=url, bitlinks=bitlinks, copy_buttons=copy_buttons))
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+
+    return resp
 
 
 @app.route("/bitlinks/go")
@@ -236,490 +311,298 @@ def bitlinks():
     Example available here: http://35.156.199.247/bitlinks/go?url=https://yandex.ru/
     """
 
-    url = html_escape(request.args.get('url', ''))
+    url = canonical_url(request.args.get('url', ''))
 
     #Search for the requested URL in the cache
-    with open('/change-me/bitlinks/cache.txt') as in_stream:
-        for line in in_stream:
-            new_line = line.strip().split('\t')
-            if new_line[0] == url:
-                #If there is, generate a page without using Ajax, immediately filling out bilinks
-                resp = make_response('''<!DOCTYPE html>
-<html lang="en">
-
-<head>
-    <meta charset="UTF-8">
-    <title>Link to Bitlinks with UTM | ''' + url + '''</title>
-    <meta name="description" content="Web service for automatic processing of URLs and generating bitlinks.">
-    <link rel="icon" type="image/png" href="/bitlinks/favicon.png">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        html {
-            height: 100%;
-            background: #092756
-        }
-        
-        #feedback-page {
-            text-align: center
-        }
-        
-        #form-main {
-            width: 100%;
-            float: left;
-            padding-top: 0
-        }
-        
-        #form-div {
-            background-color: rgba(72, 72, 72, .4);
-            width: 450px;
-            float: left;
-            left: 50%;
-            position: absolute;
-            margin-top: 140px;
-            margin-left: -260px;
-            -moz-border-radius: 7px;
-            -webkit-border-radius: 7px;
-            padding: 35px 35px 50px
-        }
-        
-        .feedback-input {
-            display: inline-block;
-            color: #3c3c3c;
-            font-family: Helvetica, Arial, sans-serif;
-            font-weight: 500;
-            font-size: 18px;
-            border-radius: 0;
-            line-height: 22px;
-            background-color: #fbfbfb;
-            padding: 13px 13px 13px 54px;
-            margin-bottom: 10px;
-            width: 100%;
-            -webkit-box-sizing: border-box;
-            -moz-box-sizing: border-box;
-            -ms-box-sizing: border-box;
-            box-sizing: border-box;
-            border: 3px solid transparent
-        }
-        
-        .feedback-input:focus {
-            background: #fff;
-            box-shadow: 0;
-            border: 3px solid #3498db;
-            color: #3498db;
-            outline: 0;
-            padding: 13px 13px 13px 54px
-        }
-        
-        #instagram,
-        #instagram:focus,
-        #link,
-        #link:focus,
-        #telegram,
-        #telegram:focus,
-        #vk,
-        #vk:focus {
-            background-size: 30px 30px;
-            background-position: 11px 8px;
-            background-repeat: no-repeat
-        }
-        
-        .focused {
-            color: #30aed6;
-            border: 3px solid #30aed6
-        }
-        
-        textarea {
-            width: 100%;
-            height: 150px;
-            line-height: 150%;
-            resize: vertical
-        }
-        
-        input:focus,
-        input:hover,
-        textarea:focus,
-        textarea:hover {
-            background-color: #fff
-        }
-        
-        .btn {
-            font-family: Montserrat, Arial, Helvetica, sans-serif;
-            float: left;
-            width: 100%;
-            border: 4px solid #fbfbfb;
-            cursor: pointer;
-            background-color: #3498db;
-            color: #fff;
-            font-size: 24px;
-            padding-top: 22px;
-            padding-bottom: 22px;
-            -webkit-appearance: none;
-            -webkit-transition: all .3s;
-            -moz-transition: all .3s;
-            transition: all .3s;
-            margin-top: -4px;
-            font-weight: 700
-        }
-        
-        .btn:hover {
-            background-color: #fbfbfb;
-            color: #0493bd
-        }
-        
-        .submit:hover {
-            color: #3498db
-        }
-        
-        @media only screen and (max-width:580px) {
-            #form-div {
-                left: 3%;
-                margin-right: 3%;
-                margin-top: 0px;
-                width: 88%;
-                margin-left: 0;
-                padding-left: 3%;
-                padding-right: 3%
-            }
-        }
-    </style>
-</head>
-
-<body>
-    <div id="form-main">
-        <div id="form-div">
-            <p class="feedback-input" id="telegram">''' + new_line[1] + '''</p>
-            <div class="submit">
-                <button class="btn" id="button-telegram" data-clipboard-target="#telegram">Copy</button>
-            </div>
-            <p class="feedback-input" id="vk">''' + new_line[2] + '''</p>
-            <div class="submit">
-                <button class="btn" id="button-vk" data-clipboard-target="#vk">Copy</button>
-            </div>
-            <p class="feedback-input" id="instagram">''' + new_line[3] + '''</p>
-            <div class="submit">
-                <button class="btn" id="button-instagram" data-clipboard-target="#instagram">Copy</button>
-            </div>
-        </div>
-    </div>
-    <link rel="stylesheet" type="text/css" href="/bitlinks/styles.css">
-    <script src="/bitlinks/clipboard.min.js"></script>
-    <script>
-        new ClipboardJS('.btn');
-    </script>
-</body>
-
-</html>''')
-
-                return resp
+    cached = cached_bitlinks(url)
+    if cached:
+        #If there is, generate a page without using Ajax, immediately filling out bilinks
+        resp = result_page(url, cached, copy_buttons=True)
+
+        return resp
 
     #If not, generate a page using Ajax and a temporary loader
-    resp = make_response('''<!DOCTYPE html>
-<html lang="en">
-
-<head>
-    <meta charset="UTF-8">
-    <title>Link to Bitlinks with UTM | ''' + url + '''</title>
-    <meta name="description" content="Web service for automatic processing of URLs and generating bitlinks.">
-    <link rel="icon" type="image/png" href="/bitlinks/favicon.png">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        html {
-            height: 100%;
-            background: #092756
-        }
-        
-        #feedback-page {
-            text-align: center
-        }
-        
-        #form-main {
-            width: 100%;
-            float: left;
-            padding-top: 0
-        }
-        
-        #form-div {
-            background-color: rgba(72, 72, 72, .4);
-            width: 450px;
-            float: left;
-            left: 50%;
-            position: absolute;
-            margin-top: 140px;
-            margin-left: -260px;
-            -moz-border-radius: 7px;
-            -webkit-border-radius: 7px;
-            padding: 35px 35px 50px
-        }
-        
-        .feedback-input {
-            display: inline-block;
-            color: #3c3c3c;
-            font-family: Helvetica, Arial, sans-serif;
-            font-weight: 500;
-            font-size: 18px;
-            border-radius: 0;
-            line-height: 22px;
-            background-color: #fbfbfb;
-            padding: 13px 13px 13px 54px;
-            margin-bottom: 10px;
-            width: 100%;
-            -webkit-box-sizing: border-box;
-            -moz-box-sizing: border-box;
-            -ms-box-sizing: border-box;
-            box-sizing: border-box;
-            border: 3px solid transparent
-        }
-        
-        .feedback-input:focus {
-            background: #fff;
-            box-shadow: 0;
-            border: 3px solid #3498db;
-            color: #3498db;
-            outline: 0;
-            padding: 13px 13px 13px 54px
-        }
-        
-        #instagram,
-        #instagram:focus,
-        #link,
-        #link:focus,
-        #telegram,
-        #telegram:focus,
-        #vk,
-        #vk:focus {
-            background-size: 30px 30px;
-            background-position: 11px 8px;
-            background-repeat: no-repeat
-        }
-        
-        .focused {
-            color: #30aed6;
-            border: 3px solid #30aed6
-        }
-        
-        textarea {
-            width: 100%;
-            height: 150px;
-            line-height: 150%;
-            resize: vertical
-        }
-        
-        input:focus,
-        input:hover,
-        textarea:focus,
-        textarea:hover {
-            background-color: #fff
-        }
-        
-        .btn {
-            font-family: Montserrat, Arial, Helvetica, sans-serif;
-            float: left;
-            width: 100%;
-            border: 4px solid #fbfbfb;
-            cursor: pointer;
-            background-color: #3498db;
-            color: #fff;
-            font-size: 24px;
-            padding-top: 22px;
-            padding-bottom: 22px;
-            -webkit-appearance: none;
-            -webkit-transition: all .3s;
-            -moz-transition: all .3s;
-            transition: all .3s;
-            margin-top: -4px;
-            font-weight: 700
-        }
-        
-        .btn:hover {
-            background-color: #fbfbfb;
-            color: #0493bd
-        }
-        
-        .submit:hover {
-            color: #3498db
-        }
-        
-        @media only screen and (max-width:580px) {
-            #form-div {
-                left: 3%;
-                margin-right: 3%;
-                margin-top: 0;
-                width: 88%;
-                margin-left: 0;
-                padding-left: 3%;
-                padding-right: 3%
-            }
-        }
-    </style>
-</head>
-
-<body>
-    <div id="form-main">
-        <div id="form-div">
-            <p class="feedback-input" id="telegram">
-                <?xml version="1.0" encoding="UTF-8" standalone="no"?>
-                    <svg xmlns:svg="http://www.w3.org/2000/svg" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0" width="105px" height="16px" viewBox="0 0 158 24" xml:space="preserve">
-                        <rect x="0" y="0" width="100%" height="100%" fill="#FFFFFF" />
-                        <path fill="#e9f4fb" d="M64 4h10v10H64V4zm20 0h10v10H84V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zM4 4h10v10H4V4zm20 0h10v10H24V4zm20 0h10v10H44V4z" />
-                        <path fill="#cae4f6" d="M144 14V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10H84zm9-9h-8v8h8V5zm-29 9V4h10v10H64zm9-9h-8v8h8V5zm-29 9V4h10v10H44zm9-9h-8v8h8V5zm-29 9V4h10v10H24zm9-9h-8v8h8V5zM4 14V4h10v10H4zm9-9H5v8h8V5z" />
-                        <g>
-                            <path fill="#e1f0fa" d="M-58 16V2h14v14h-14zm13-13h-12v12h12V3z" />
-                            <path fill="#b0d7f1" fill-opacity="0.3" d="M-40 0h18v18h-18z" />
-                            <path fill="#c2e0f4" d="M-40 18V0h18v18h-18zm17-17h-16v16h16V1z" />
-                            <path fill="#b0d7f1" fill-opacity="0.7" d="M-20 0h18v18h-18z" />
-                            <path fill="#71b7e6" d="M-20 18V0h18v18h-18zM-3 1h-16v16h16V1z" />
-                            <animateTransform attributeName="transform" type="translate" values="20 0;40 0;60 0;80 0;100 0;120 0;140 0;160 0;180 0;200 0" calcMode="discrete" dur="3200ms" repeatCount="indefinite" />
-                        </g>
-                    </svg>
-            </p>
-            <div class="submit">
-                <button class="btn" id="button-telegram" data-clipboard-target="#telegram">Copy</button>
-            </div>
-            <p class="feedback-input" id="vk">
-                <?xml version="1.0" encoding="UTF-8" standalone="no"?>
-                    <svg xmlns:svg="http://www.w3.org/2000/svg" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0" width="105px" height="16px" viewBox="0 0 158 24" xml:space="preserve">
-                        <rect x="0" y="0" width="100%" height="100%" fill="#FFFFFF" />
-                        <path fill="#e9f4fb" d="M64 4h10v10H64V4zm20 0h10v10H84V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zM4 4h10v10H4V4zm20 0h10v10H24V4zm20 0h10v10H44V4z" />
-                        <path fill="#cae4f6" d="M144 14V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10H84zm9-9h-8v8h8V5zm-29 9V4h10v10H64zm9-9h-8v8h8V5zm-29 9V4h10v10H44zm9-9h-8v8h8V5zm-29 9V4h10v10H24zm9-9h-8v8h8V5zM4 14V4h10v10H4zm9-9H5v8h8V5z" />
-                        <g>
-                            <path fill="#e1f0fa" d="M-58 16V2h14v14h-14zm13-13h-12v12h12V3z" />
-                            <path fill="#b0d7f1" fill-opacity="0.3" d="M-40 0h18v18h-18z" />
-                            <path fill="#c2e0f4" d="M-40 18V0h18v18h-18zm17-17h-16v16h16V1z" />
-                            <path fill="#b0d7f1" fill-opacity="0.7" d="M-20 0h18v18h-18z" />
-                            <path fill="#71b7e6" d="M-20 18V0h18v18h-18zM-3 1h-16v16h16V1z" />
-                            <animateTransform attributeName="transform" type="translate" values="20 0;40 0;60 0;80 0;100 0;120 0;140 0;160 0;180 0;200 0" calcMode="discrete" dur="3200ms" repeatCount="indefinite" />
-                        </g>
-                    </svg>
-            </p>
-            <div class="submit">
-                <button class="btn" id="button-vk" data-clipboard-target="#vk">Copy</button>
-            </div>
-            <p class="feedback-input" id="instagram">
-                <?xml version="1.0" encoding="UTF-8" standalone="no"?>
-                    <svg xmlns:svg="http://www.w3.org/2000/svg" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0" width="105px" height="16px" viewBox="0 0 158 24" xml:space="preserve">
-                        <rect x="0" y="0" width="100%" height="100%" fill="#FFFFFF" />
-                        <path fill="#e9f4fb" d="M64 4h10v10H64V4zm20 0h10v10H84V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zm20 0h10v10h-10V4zM4 4h10v10H4V4zm20 0h10v10H24V4zm20 0h10v10H44V4z" />
-                        <path fill="#cae4f6" d="M144 14V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10h-10zm9-9h-8v8h8V5zm-29 9V4h10v10H84zm9-9h-8v8h8V5zm-29 9V4h10v10H64zm9-9h-8v8h8V5zm-29 9V4h10v10H44zm9-9h-8v8h8V5zm-29 9V4h10v10H24zm9-9h-8v8h8V5zM4 14V4h10v10H4zm9-9H5v8h8V5z" />
-                        <g>
-                            <path fill="#e1f0fa" d="M-58 16V2h14v14h-14zm13-13h-12v12h12V3z" />
-                            <path fill="#b0d7f1" fill-opacity="0.3" d="M-40 0h18v18h-18z" />
-                            <path fill="#c2e0f4" d="M-40 18V0h18v18h-18zm17-17h-16v16h16V1z" />
-                            <path fill="#b0d7f1" fill-opacity="0.7" d="M-20 0h18v18h-18z" />
-                            <path fill="#71b7e6" d="M-20 18V0h18v18h-18zM-3 1h-16v16h16V1z" />
-                            <animateTransform attributeName="transform" type="translate" values="20 0;40 0;60 0;80 0;100 0;120 0;140 0;160 0;180 0;200 0" calcMode="discrete" dur="3200ms" repeatCount="indefinite" />
-                        </g>
-                    </svg>
-            </p>
-            <div class="submit">
-                <button class="btn" id="button-instagram" data-clipboard-target="#instagram">Copy</button>
-            </div>
-        </div>
-    </div>
-    <link rel="stylesheet" type="text/css" href="/bitlinks/styles.css">
-    <script src="/bitlinks/jquery.min.js"></script>
-    <script src="/bitlinks/clipboard.min.js"></script>
-    <script>
-        function get_bitlinks(t) {
-            $.post("/bitlinks/ajax", {
-                url: t
-            }).done(function(t) {
-                $(telegram).text(t.bitlink_telegram), $(vk).text(t.bitlink_vk), $(instagram).text(t.bitlink_instagram)
-            }).fail(function() {
-                $(telegram).text("Connection Error! Try: http://35.156.199.247/bitlinks/nojs?url=''' + url + '''"), $(vk).text("Connection Error! Try: http://35.156.199.247/bitlinks/nojs?url=''' + url + '''"), $(instagram).text("Connection Error! Try: http://35.156.199.247/bitlinks/nojs?url=''' + url + '''")
-            })
-        }
-        new get_bitlinks("''' + url + '''"), new ClipboardJS(".btn");
-    </script>
-</body>
-
-</html>''')
+    with measure('render'):
+        resp = make_response(render_template('loader.html', url=url))
 
     return resp
 
 
-@app.route("/bitlinks/ajax", methods=['POST'])
-def ajax():
-    """Function to wait for a response from https://bitly.com/ and refresh the page (/bitlinks/go) without reloading using Ajax."""
+class Rejected(Exception):
+    """The requested URL is not allowed: not a page of our website or the page does not exist.
+    status_code is the answer of the page, if it was checked (0 - it could not be checked)."""
 
-    url = request.form['url']
+    def __init__(self, reason, status_code=None):
+        super().__init__(reason)
+        self.status_code = status_code
 
-    #Search for the requested URL in the cache
-    with open('/change-me/bitlinks/cache.txt') as in_stream:
-        for line in in_stream:
-            new_line = line.strip().split('\t')
-            if new_line[0] == url:
-                #If there is, generate a page without using https://bitly.com
-
-                return jsonify({
-                    'bitlink_telegram': new_line[1],
-                    'bitlink_vk': new_line[2],
-                    'bitlink_instagram': new_line[3],
-                })
-
-    your_website = 'your-website-address'
-    clean_url, lenght, status_code = None, len(your_website), None
-
-    #Getting the response code of the requested page
-    try:
-        status_code = urllib.request.urlopen(url).getcode()
-    except:
-        status_code = 0
+    @property
+    def temporary(self):
+        """The page could not be checked or its site failed (5xx): it may be allowed later."""
 
-    #Checking that the user has requested an existing page of an allowed website
-    if url[:lenght] != your_website or status_code != 200:
+        return self.status_code is not None and (self.status_code == 0 or self.status_code >= 500)
 
-        return jsonify({
-            'bitlink_telegram': 'Bad URL or HTTP / Connection Error',
-            'bitlink_vk': 'Only correct documents (SATUS_CODE == 200 OK; NOT https://site.ru/123456) from %our_website% are allowed.',
-            'bitlink_instagram': ':(',
-        })
 
-    #If the URL is correct, clear it of unnecessary tags
-    elif '?from=' in url or '&from=' in url or '&amp;from=' in url:
-        clean_url = url[:url.find('from=')]
+def make_bitlinks(url, progress=None, hold=None):
+    """Function to check the requested page, shorten it for every channel and write the result to the cache.
+    Returns the dictionary {channel: bitlink}, raises Rejected if the URL is not allowed.
+    Channels whose shortening failed are missing from it: they are retried in the background.
+    progress(channel, bitlink), if given, is called for every channel as soon as its bitlink is known.
+    hold, given by the single-flight, keeps its lock until the new bitlinks are written to the cache."""
 
-    elif '?' not in url:
-        clean_url = url + '?'
+    #Checking that the user has requested a page of an allowed website
+    if not url.startswith(settings.YOUR_WEBSITE):
+        raise Rejected('Not a page of %our_website%')
 
-    elif '?utm_' in url or '&utm_' in url or '&amp;utm_' in url:
-        clean_url = url[:url.find('utm_')]
+    #The checks and shortenings run on the pool, they add their time to the request that waits for them
+    timings = timing.current()
 
-    elif '?_openstat=' in url or '&_openstat=' in url or '&amp;_openstat=' in url:
-        clean_url = url[:url.find('_openstat=')]
+    #Bitlinks of channels that are already cached are reused, only the missing ones are made
+    with measure('cache'):
+        bitlinks = cache.get(url) or {}
+    missing = [channel for channel in settings.CHANNELS if channel not in bitlinks]
+
+    #Create URL`s with the necessary UTM tags for every missing channel
+    #(the URL is already canonical: unnecessary tags are removed by normalize_url)
+    urls = [add_query(url, settings.CHANNELS[channel]) for channel in missing]
+
+    if settings.SPECULATIVE_SHORTENING:
+        #Shorten links while the page is being checked, the bitlinks are used only if the page exists
+        status = executor.submit(check_page, url, timings)
+        shortened = [executor.submit(shorten, channel, long_url, timings) for channel, long_url in zip(missing, urls)]
+        status_code = status.result()
+        if status_code != 200:
+            raise Rejected(status_reason(status_code), status_code)
 
     else:
-        clean_url = url + '&'
+        #Checking that the page exists, then in parallel shorten links on the shared thread pool
+        status_code = check_page(url, timings)
+        if status_code != 200:
+            raise Rejected(status_reason(status_code), status_code)
+        shortened = [executor.submit(shorten, channel, long_url, timings) for channel, long_url in zip(missing, urls)]
+
+    #Cached channels are known at once, the others as soon as their link is shortened
+    if progress is not None:
+        for channel in settings.CHANNELS:
+            if channel in bitlinks:
+                progress(channel, bitlinks[channel])
+
+    #Response from the bilty - is dictionary, take the short links from it.
+    #A failed channel does not spoil the others: they are cached, and it is retried later
+    channels = dict(zip(shortened, missing))
+    new_bitlinks = {}
+    failed = False
+    for future in as_completed(shortened):
+        try:
+            new_bitlinks[channels[future]] = future.result()['url']
+        except SHORTEN_ERRORS:
+            failed = True
+            continue
+        if progress is not None:
+            progress(channels[future], new_bitlinks[channels[future]])
+
+    #Write the data to the cache. This runs under the single-flight lock, and a request of another worker
+    #waiting for it must find the bitlinks when it gets the lock: the lock is held until the writer has written them
+    if new_bitlinks:
+        release = hold() if hold is not None else None
+        try:
+            cache.add(url, new_bitlinks, release)
+        except Exception:
+            if release is not None:
+                release()
+            raise
+    bitlinks.update(new_bitlinks)
+    if failed:
+        retry.schedule(url, complete_bitlinks)
+
+    return {channel: bitlinks[channel] for channel in settings.CHANNELS if channel in bitlinks}
+
+
+def complete_bitlinks(url):
+    """Function to make the bitlinks still missing in the cache entry of a page that was already checked.
+    Runs in the background; returns True when the entry is complete."""
+
+    bitlinks = cache.get(url) or {}
+    new_bitlinks = {}
+    for channel in settings.CHANNELS:
+        if channel not in bitlinks:
+            try:
+                new_bitlinks[channel] = shorten(channel, add_query(url, settings.CHANNELS[channel]))['url']
+            except SHORTEN_ERRORS:
+                pass
+
+    if new_bitlinks:
+        cache.add(url, new_bitlinks)
+    return len(bitlinks) + len(new_bitlinks) >= len(settings.CHANNELS)
+
+
+def check_page(url, timings=None):
+    """Function to get the status code of the requested page, measured for the metrics (and the timings of the request)."""
+
+    started = time.perf_counter()
+    status_code = validator.status(url)
+    elapsed = time.perf_counter() - started
+    status_seconds.observe(elapsed, str(status_code) if status_code else 'error')
+    if timings is not None:
+        timings.add('status', elapsed)
+
+    return status_code
+
+
+def shorten(channel, long_url, timings=None):
+    """Function to shorten the link of a channel with Bitly, measured for the metrics (and the timings of the request)."""
+
+    started = time.perf_counter()
+    try:
+        result = bitly.shorten(long_url)
+    except SHORTEN_ERRORS as error:
+        bitly_seconds.observe(time.perf_counter() - started, channel, 'error')
+        bitly_errors.inc(channel, type(error).__name__)
+        raise
+    finally:
+        if timings is not None:
+            timings.add('bitly-' + channel, time.perf_counter() - started)
+    bitly_seconds.observe(time.perf_counter() - started, channel, 'ok')
+
+    return result
+
+
+def status_reason(status_code):
+    """Function to describe why a page with this status code is not allowed."""
 
-    #Create URL`s with the necessary UTM tags for 3 social networks
-    urls = [
-        clean_url + 'utm_source=telegram&utm_medium=social&utm_campaign=our-channel',
-        clean_url + 'utm_source=vk&utm_medium=social&utm_campaign=our-public',
-        clean_url + 'utm_source=instagram&utm_medium=social&utm_campaign=our-profile',
+    if status_code == 0:
+        return 'HTTP / Connection Error'
+    if status_code >= 500:
+        return 'The page answered %d instead of 200 OK, try again later' % status_code
+    return 'The page answered %d instead of 200 OK' % status_code
+
+
+def get_bitlinks(url, progress=None):
+    """Function to make bitlinks for a URL that is not in the cache.
+    URLs rejected recently are answered from the negative cache without checking the page again
+    (only definite rejections are remembered: a page that did not answer or failed is checked again next time).
+    progress is passed to make_bitlinks; it is not called when the bitlinks are made by another request."""
+
+    reason = rejected.get(url)
+    if reason is not None:
+        raise Rejected(reason)
+
+    #Only one request (across all workers) shortens the same URL, the others wait and reuse its result
+    try:
+        with measure('make'):
+            return single_flight.do(url, lambda hold: make_bitlinks(url, progress, hold), lambda: cached_bitlinks(url, counted=False))
+    except Rejected as error:
+        if not error.temporary:
+            rejected.set(url, str(error))
+        raise
+
+
+def rejected_bitlinks(error):
+    """Function to show the reason of a rejection in place of the bitlinks, one line per channel.
+    The reason comes first, so it is shown however few channels there are."""
+
+    messages = [
+        ':( ' + str(error),
+        'Bad URL or HTTP / Connection Error',
+        'Only correct documents (SATUS_CODE == 200 OK; NOT https://site.ru/123456) from %our_website% are allowed.',
     ]
+    messages += [''] * (len(settings.CHANNELS) - len(messages))
+
+    return dict(zip(settings.CHANNELS, messages))
 
-    #Connect to the bitly by API
-    bitly = bitly_api.Connection(access_token='your-bitly-token')
 
-    #In parallel, run the function of shorten links using threads (multiprocessing.dummy)
-    pool = ThreadPool(3)
+@app.errorhandler(Busy)
+def busy(error):
+    """Function to answer quickly when the thread pool queue is full."""
 
-    results = pool.map(bitly.shorten, urls)
+    return make_response('Service is busy, try again in a few seconds', 503, {'Retry-After': '5'})
 
-    pool.close()
-    pool.join()
 
-    #Response from the bilty - is dictionary, assigned to the variabled obtained short links
-    bitlink_telegram, bitlink_vk, bitlink_instagram = results[0]['url'], results[1]['url'], results[2]['url']
+@app.route("/bitlinks/pool")
+def pool():
+    """Function to show the state of the worker's thread pool and of the Bitly governor (JSON)."""
 
-    #Write the data to the cache
-    with open('/change-me/bitlinks/cache.txt', 'a') as out_stream:
-        out_stream.write('\n' + url + '\t' + bitlink_telegram + '\t' + bitlink_vk + '\t' + bitlink_instagram)
+    return jsonify(dict(executor.stats(), bitly=bitly.stats()))
 
-    return jsonify({
-        'bitlink_telegram': bitlink_telegram,
-        'bitlink_vk': bitlink_vk,
-        'bitlink_instagram': bitlink_instagram,
-    })
+
+@app.route("/bitlinks/metrics")
+def metrics():
+    """Function to export the metrics of all workers in the Prometheus text format."""
+
+    return Response(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route("/bitlinks/ajax", methods=['POST'])
+def ajax():
+    """Function to wait for a response from https://bitly.com/ and refresh the page (/bitlinks/go) without reloading using Ajax."""
+
+    url = canonical_url(request.form['url'])
+
+    #Search for the requested URL in the cache
+    cached = cached_bitlinks(url)
+    if cached:
+        #If there is, generate a page without using https://bitly.com
+
+        return jsonify(channel_json(cached))
+
+    try:
+        bitlinks = get_bitlinks(url)
+    except Rejected as error:
+
+        return jsonify(channel_json(rejected_bitlinks(error)))
+
+    return jsonify(channel_json(bitlinks, pending_text()))
+
+
+@app.route("/bitlinks/batch", methods=['POST'])
+def batch():
+    """Function to make bitlinks for many URLs at once (e.g. for digests).
+    Takes JSON {"urls": [...]} or a JSON list of URLs, or a form field "urls" with one URL per line.
+    Streams NDJSON: one line per URL as soon as it is ready, cache hits first."""
+
+    if request.is_json:
+        urls = request.get_json(silent=True)
+        if isinstance(urls, dict):
+            urls = urls.get('urls')
+        if not isinstance(urls, list):
+            return make_response('Expected JSON {"urls": [...]} or a list of URLs', 400)
+    else:
+        urls = request.form.get('urls', '').split('\n')
+
+    #Deduplicate canonical URLs, keeping the order
+    urls = list(dict.fromkeys(canonical_url(url) for url in urls if isinstance(url, str) and url.strip()))
+    if len(urls) > settings.BATCH_MAX_URLS:
+        return make_response('No more than %d URLs at once' % settings.BATCH_MAX_URLS, 413)
+
+    def line(url, bitlinks=None, error=None):
+        if error is not None:
+            return json.dumps({'url': url, 'error': error}) + '\n'
+        return json.dumps(dict(url=url, **channel_json(bitlinks, None))) + '\n'
+
+    def generate():
+        futures = {}
+        for url in urls:
+            cached = cached_bitlinks(url)
+            if cached:
+                yield line(url, cached)
+                continue
+            try:
+                futures[batch_executor.submit(get_bitlinks, url)] = url
+            except Busy:
+                yield line(url, error='Service is busy, try again in a few seconds')
+
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                yield line(url, future.result())
+            except Rejected as error:
+                yield line(url, error=str(error))
+            except Busy:
+                yield line(url, error='Service is busy, try again in a few seconds')
+            except Exception as error:
+                yield line(url, error='Bitly Error: %s' % error)
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
 
 
 @app.route("/bitlinks/nojs")
@@ -728,382 +611,66 @@ def nojs():
     Example available here: http://35.156.199.247/bitlinks/nojs?url=https://yandex.ru/
     """
 
-    url = html_escape(request.args.get('url', ''))
-
-    with open('/change-me/bitlinks/cache.txt') as in_stream:
-        for line in in_stream:
-            new_line = line.strip().split('\t')
-            if new_line[0] == url:
-                resp = make_response('''<!DOCTYPE html>
-<html lang="en">
-
-<head>
-    <meta charset="UTF-8">
-    <title>Link to Bitlinks with UTM | ''' + url + '''</title>
-    <meta name="description" content="Web service for automatic processing of URLs and generating bitlinks.">
-    <link rel="icon" type="image/png" href="/bitlinks/favicon.png">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        html {
-            height: 100%;
-            background: #092756
-        }
-        
-        #feedback-page {
-            text-align: center
-        }
-        
-        #form-main {
-            width: 100%;
-            float: left;
-            padding-top: 0
-        }
-        
-        #form-div {
-            background-color: rgba(72, 72, 72, .4);
-            width: 450px;
-            float: left;
-            left: 50%;
-            position: absolute;
-            margin-top: 140px;
-            margin-left: -260px;
-            -moz-border-radius: 7px;
-            -webkit-border-radius: 7px;
-            padding: 35px 35px 50px
-        }
-        
-        .feedback-input {
-            display: inline-block;
-            color: #3c3c3c;
-            font-family: Helvetica, Arial, sans-serif;
-            font-weight: 500;
-            font-size: 18px;
-            border-radius: 0;
-            line-height: 22px;
-            background-color: #fbfbfb;
-            padding: 13px 13px 13px 54px;
-            margin-bottom: 10px;
-            width: 100%;
-            -webkit-box-sizing: border-box;
-            -moz-box-sizing: border-box;
-            -ms-box-sizing: border-box;
-            box-sizing: border-box;
-            border: 3px solid transparent
-        }
-        
-        .feedback-input:focus {
-            background: #fff;
-            box-shadow: 0;
-            border: 3px solid #3498db;
-            color: #3498db;
-            outline: 0;
-            padding: 13px 13px 13px 54px
-        }
-        
-        #instagram,
-        #instagram:focus,
-        #link,
-        #link:focus,
-        #telegram,
-        #telegram:focus,
-        #vk,
-        #vk:focus {
-            background-size: 30px 30px;
-            background-position: 11px 8px;
-            background-repeat: no-repeat
-        }
-        
-        .focused {
-            color: #30aed6;
-            border: 3px solid #30aed6
-        }
-        
-        textarea {
-            width: 100%;
-            height: 150px;
-            line-height: 150%;
-            resize: vertical
-        }
-        
-        input:focus,
-        input:hover,
-        textarea:focus,
-        textarea:hover {
-            background-color: #fff
-        }
-        
-        .btn {
-            font-family: Montserrat, Arial, Helvetica, sans-serif;
-            float: left;
-            width: 100%;
-            border: 4px solid #fbfbfb;
-            cursor: pointer;
-            background-color: #3498db;
-            color: #fff;
-            font-size: 24px;
-            padding-top: 22px;
-            padding-bottom: 22px;
-            -webkit-appearance: none;
-            -webkit-transition: all .3s;
-            -moz-transition: all .3s;
-            transition: all .3s;
-            margin-top: -4px;
-            font-weight: 700
-        }
-        
-        .btn:hover {
-            background-color: #fbfbfb;
-            color: #0493bd
-        }
-        
-        .submit:hover {
-            color: #3498db
-        }
-        
-        @media only screen and (max-width:580px) {
-            #form-div {
-                left: 3%;
-                margin-right: 3%;
-                margin-top: 0;
-                width: 88%;
-                margin-left: 0;
-                padding-left: 3%;
-                padding-right: 3%
-            }
-        }
-    </style>
-</head>
-
-<body>
-    <div id="form-main">
-        <div id="form-div">
-            <p class="feedback-input" id="telegram">''' + new_line[1] + '''</p>
-            <p class="feedback-input" id="vk">''' + new_line[2] + '''</p>
-            <p class="feedback-input" id="instagram">''' + new_line[3] + '''</p>
-        </div>
-    </div>
-    <link rel="stylesheet" type="text/css" href="/bitlinks/styles.css">
-</body>
-
-</html>''')
-
-                return resp
-
-    your_website = 'your-website-address'
-    clean_url, lenght, status_code = None, len(your_website), None
+    url = canonical_url(request.args.get('url', ''))
 
-    try:
-        status_code = urllib.request.urlopen(url).getcode()
-    except:
-        status_code = 0
+    cached = cached_bitlinks(url)
+    if cached:
+        resp = result_page(url, cached)
 
-    if url[:lenght] != your_website or status_code != 200:
-        resp = make_response('''<!DOCTYPE html>
-<html lang="en">
+        return resp
 
-<head>
-    <meta charset="UTF-8">
-    <title>Bad URL or HTTP / Connection Error | ''' + url + '''</title>
-</head>
+    #If not, the page is streamed: the shell with loaders at once, then every bitlink as soon as it is made
+    made = queue.Queue()
+    #The bitlinks are made on the pool, their timings go to the log line written when the page is sent
+    future = stream_executor.submit(timing.bind(g.timings, get_bitlinks), url, lambda channel, bitlink: made.put((channel, bitlink)))
+    future.add_done_callback(lambda future: made.put(None))
 
-<body>
-    <h1>Bad URL or HTTP / Connection Error</h1>
-    <p>Only <u>correct documents</u> (SATUS_CODE==<strong>200 OK</strong>; <u>NOT</u> https://site.ru/123456) from %our_website% are allowed.</p>
-</body>
+    template = app.jinja_env.get_template('nojs.html')
+    chunks = template.generate(url=url, results=stream_bitlinks(made, future), flush=Markup(FLUSH))
+    resp = Response(flushed(chunks), mimetype='text/html', headers={'X-Accel-Buffering': 'no'})
 
-</html>''')
+    return resp
 
-        return resp
 
-    elif '?from=' in url or '&from=' in url or '&amp;from=' in url:
-        clean_url = url[:url.find('from=')]
+#Marker in streamed templates ({{ flush }}): the page is sent to the browser up to it
+FLUSH = '<!--flush-->'
 
-    elif '?' not in url:
-        clean_url = url + '?'
 
-    elif '?utm_' in url or '&utm_' in url or '&amp;utm_' in url:
-        clean_url = url[:url.find('utm_')]
+def flushed(chunks):
+    """Function to join the small pieces yielded by a template into one chunk per {{ flush }},
+    so a streamed page is sent in a few writes and each of them is complete."""
 
-    elif '?_openstat=' in url or '&_openstat=' in url or '&amp;_openstat=' in url:
-        clean_url = url[:url.find('_openstat=')]
+    buffer = []
+    for chunk in chunks:
+        buffer.append(chunk)
+        if FLUSH in chunk:
+            yield ''.join(buffer).replace(FLUSH, '')
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
 
-    else:
-        clean_url = url + '&'
 
-    urls = [
-        clean_url + 'utm_source=telegram&utm_medium=social&utm_campaign=our-channel',
-        clean_url + 'utm_source=vk&utm_medium=social&utm_campaign=our-public',
-        clean_url + 'utm_source=instagram&utm_medium=social&utm_campaign=our-profile',
-    ]
+def stream_bitlinks(made, future):
+    """Function to yield (order, channel, text) for the streamed page: bitlinks in the order they are made,
+    or the error in place of all of them."""
 
-    bitly = bitly_api.Connection(access_token='your-bitly-token')
-
-    pool = ThreadPool(3)
-
-    results = pool.map(bitly.shorten, urls)
-
-    pool.close()
-    pool.join()
-
-    bitlink_telegram, bitlink_vk, bitlink_instagram = results[0]['url'], results[1]['url'], results[2]['url']
-
-    resp = make_response('''<!DOCTYPE html>
-<html lang="en">
-
-<head>
-    <meta charset="UTF-8">
-    <title>Link to Bitlinks with UTM | ''' + url + '''</title>
-    <meta name="description" content="Web service for automatic processing of URLs and generating bitlinks.">
-    <link rel="icon" type="image/png" href="/bitlinks/favicon.png">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        html {
-            height: 100%;
-            background: #092756
-        }
-        
-        #feedback-page {
-            text-align: center
-        }
-        
-        #form-main {
-            width: 100%;
-            float: left;
-            padding-top: 0
-        }
-        
-        #form-div {
-            background-color: rgba(72, 72, 72, .4);
-            width: 450px;
-            float: left;
-            left: 50%;
-            position: absolute;
-            margin-top: 140px;
-            margin-left: -260px;
-            -moz-border-radius: 7px;
-            -webkit-border-radius: 7px;
-            padding: 35px 35px 50px
-        }
-        
-        .feedback-input {
-            display: inline-block;
-            color: #3c3c3c;
-            font-family: Helvetica, Arial, sans-serif;
-            font-weight: 500;
-            font-size: 18px;
-            border-radius: 0;
-            line-height: 22px;
-            background-color: #fbfbfb;
-            padding: 13px 13px 13px 54px;
-            margin-bottom: 10px;
-            width: 100%;
-            -webkit-box-sizing: border-box;
-            -moz-box-sizing: border-box;
-            -ms-box-sizing: border-box;
-            box-sizing: border-box;
-            border: 3px solid transparent
-        }
-        
-        .feedback-input:focus {
-            background: #fff;
-            box-shadow: 0;
-            border: 3px solid #3498db;
-            color: #3498db;
-            outline: 0;
-            padding: 13px 13px 13px 54px
-        }
-        
-        #instagram,
-        #instagram:focus,
-        #link,
-        #link:focus,
-        #telegram,
-        #telegram:focus,
-        #vk,
-        #vk:focus {
-            background-size: 30px 30px;
-            background-position: 11px 8px;
-            background-repeat: no-repeat
-        }
-        
-        .focused {
-            color: #30aed6;
-            border: 3px solid #30aed6
-        }
-        
-        textarea {
-            width: 100%;
-            height: 150px;
-            line-height: 150%;
-            resize: vertical
-        }
-        
-        input:focus,
-        input:hover,
-        textarea:focus,
-        textarea:hover {
-            background-color: #fff
-        }
-        
-        .btn {
-            font-family: Montserrat, Arial, Helvetica, sans-serif;
-            float: left;
-            width: 100%;
-            border: 4px solid #fbfbfb;
-            cursor: pointer;
-            background-color: #3498db;
-            color: #fff;
-            font-size: 24px;
-            padding-top: 22px;
-            padding-bottom: 22px;
-            -webkit-appearance: none;
-            -webkit-transition: all .3s;
-            -moz-transition: all .3s;
-            transition: all .3s;
-            margin-top: -4px;
-            font-weight: 700
-        }
-        
-        .btn:hover {
-            background-color: #fbfbfb;
-            color: #0493bd
-        }
-        
-        .submit:hover {
-            color: #3498db
-        }
-        
-        @media only screen and (max-width:580px) {
-            #form-div {
-                left: 3%;
-                margin-right: 3%;
-                margin-top: 0;
-                width: 88%;
-                margin-left: 0;
-                padding-left: 3%;
-                padding-right: 3%
-            }
-        }
-    </style>
-</head>
-
-<body>
-    <div id="form-main">
-        <div id="form-div">
-            <p class="feedback-input" id="telegram">''' + bitlink_telegram + '''</p>
-            <p class="feedback-input" id="vk">''' + bitlink_vk + '''</p>
-            <p class="feedback-input" id="instagram">''' + bitlink_instagram + '''</p>
-        </div>
-    </div>
-    <link rel="stylesheet" type="text/css" href="/bitlinks/styles.css">
-</body>
-
-</html>''')
-
-    with open('/change-me/bitlinks/cache.txt', 'a') as out_stream:
-        out_stream.write('\n' + url + '\t' + bitlink_telegram + '\t' + bitlink_vk + '\t' + bitlink_instagram)
+    order = {channel: index for index, channel in enumerate(settings.CHANNELS, 1)}
+    shown = set()
+    for channel, bitlink in iter(made.get, None):
+        shown.add(channel)
+        yield order[channel], channel, bitlink
 
-    return resp
+    try:
+        bitlinks = future.result()
+    except Rejected as error:
+        bitlinks = rejected_bitlinks(error)
+    except Exception as error:
+        bitlinks = dict.fromkeys(settings.CHANNELS, 'Bitly Error: %s' % error)
+
+    #Bitlinks made by another request (or an error) come all at once, failed channels get a placeholder
+    for channel in settings.CHANNELS:
+        if channel not in shown:
+            yield order[channel], channel, bitlinks.get(channel, pending_text())
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0')
@@ -0,0 +1,92 @@
+"""Client for the https://bitly.com/ API, created once per uwsgi worker.
+
+Keeps a pool of persistent HTTP/1.1 connections, so the three shorten() calls of a request
+reuse already open TCP+TLS connections instead of opening new ones.
+Safe to use from the threads of the shared executor: each call takes its own connection from the pool."""
+
+import email.utils
+import http.client
+import json
+import time
+from urllib.parse import urlencode, urlsplit
+
+from http_pool import ConnectionPool
+
+
+#API v3 answers these with status_code 500, but they are mistakes of the request, not of Bitly
+REQUEST_ERRORS = ('INVALID_URI', 'MISSING_ARG_LONGURL', 'INVALID_ARG_LONGURL', 'ALREADY_A_BITLY_LINK', 'INVALID_LOGIN')
+
+
+class BitlyError(Exception):
+    """https://bitly.com/ answered with an error. retry_after is the delay it asked for (seconds) or None."""
+
+    def __init__(self, code, text, retry_after=None):
+        super().__init__('%s: %s' % (code, text))
+        self.code = code
+        self.text = text
+        self.retry_after = retry_after
+
+    @property
+    def rate_limited(self):
+        """Too many requests: HTTP 429 or API v3 RATE_LIMIT_EXCEEDED (403)."""
+
+        return self.code == 429 or self.text == 'RATE_LIMIT_EXCEEDED'
+
+    @property
+    def temporary(self):
+        """Bitly itself is failing (5xx), the same request may succeed later."""
+
+        return isinstance(self.code, int) and self.code >= 500 and self.text not in REQUEST_ERRORS
+
+
+#Errors of a single shorten() call: an error answer, a network error or a broken response
+SHORTEN_ERRORS = (BitlyError, OSError, http.client.HTTPException, ValueError)
+
+
+class BitlyClient:
+    """Bitly API v3 client with a keep-alive connection pool and separate connect / read timeouts."""
+
+    def __init__(self, access_token, api='https://api-ssl.bitly.com', pool_size=12, connect_timeout=3, read_timeout=10):
+        self.access_token = access_token
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        api = urlsplit(api)
+        self._path = api.path.rstrip('/')
+        self._pool = ConnectionPool(api.scheme, api.hostname, api.port, pool_size, connect_timeout, read_timeout)
+
+    def shorten(self, long_url):
+        """Shorten the URL. Returns a dictionary with 'url' (the bitlink), 'hash' and 'long_url'."""
+
+        response = self._request('/v3/shorten', {'access_token': self.access_token, 'longUrl': long_url, 'format': 'json'})
+        if response.get('status_code') != 200:
+            raise BitlyError(response.get('status_code'), response.get('status_txt'))
+        return response['data']
+
+    def _request(self, method, params):
+        path = self._path + method + '?' + urlencode(params)
+        response, body = self._pool.request('GET', path, {'Connection': 'keep-alive'})
+        if response.status != 200:
+            raise BitlyError(response.status, response.reason, parse_retry_after(response.getheader('Retry-After')))
+        return json.loads(body.decode('utf-8'))
+
+    @property
+    def connections_opened(self):
+        return self._pool.connections_opened
+
+    def close(self):
+        """Close all pooled connections."""
+
+        self._pool.close()
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (a number of seconds or an HTTP date), None if it is missing or broken."""
+
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value.strip())
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
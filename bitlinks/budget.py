@@ -0,0 +1,52 @@
+"""Byte budget of the loader page (/bitlinks/go for a URL that is not cached yet).
+
+The loader page is what the team sees on slow mobile connections while the bitlinks are made,
+so its weight is watched: the HTML and the assets it references, as sent with gzip.
+Run before a release (or in CI), it fails with exit code 1 when the page grows past LOADER_PAGE_BUDGET:
+    python budget.py
+The page is rendered from the templates and assets alone, as bitlinks.py sets them up, without starting the service."""
+
+import gzip
+import os
+import re
+import sys
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from assets import Assets
+import settings
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+#A typical requested URL is 100-130 characters long
+SAMPLE_URL = 'https://subdomain.domain.ru/category/page-name-some-id-with-a-rather-long-title-of-the-article-1234567'
+
+
+def page_weight(url=SAMPLE_URL):
+    """Return {part: bytes} of the loader page: the gzipped HTML and each referenced asset as sent with gzip."""
+
+    assets = Assets(ROOT)
+    environment = Environment(loader=FileSystemLoader(os.path.join(ROOT, 'templates')),
+                              autoescape=select_autoescape(['html', 'svg']), trim_blocks=True, lstrip_blocks=True)
+    environment.globals.update(asset_url=assets.url, channels=settings.CHANNELS)
+    html = environment.get_template('loader.html').render(url=url).encode('utf-8')
+
+    weight = {'loader.html': len(gzip.compress(html, settings.GZIP_LEVEL))}
+    for hashed_name in re.findall(r'/bitlinks/assets/([^"\'?#]+)', html.decode('utf-8')):
+        asset = assets.get(hashed_name)
+        weight[asset.name] = len(asset.negotiate('gzip')[1])
+    return weight
+
+
+def main():
+    weight = page_weight()
+    for part, size in weight.items():
+        print('%s: %d' % (part, size))
+    total = sum(weight.values())
+    print('total: %d of %d bytes' % (total, settings.LOADER_PAGE_BUDGET))
+    if total > settings.LOADER_PAGE_BUDGET:
+        sys.exit('The loader page is over its byte budget by %d bytes' % (total - settings.LOADER_PAGE_BUDGET))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""Cache of generated bitlinks.
+
+Entries are kept per (URL, channel), so adding a channel to CHANNELS in settings.py
+only needs the missing bitlinks to be made. A lookup returns a dictionary {channel: bitlink}.
+
+Two backends are available, chosen by CACHE_BACKEND in settings.py.
+
+'file' - tab-separated text files, one bitlink per line:
+    url<TAB>channel<TAB>bitlink
+Lines of the old format with the 3 original channels are read as well:
+    url<TAB>bitlink_telegram<TAB>bitlink_vk<TAB>bitlink_instagram
+New bitlinks are buffered and appended in batches to segments next to cache.txt, which are merged
+into cache.txt and its sorted index cache.txt.index without duplicates in the background (see segments.py).
+Every uwsgi worker maps the sorted index into memory read-only, so one copy of it is shared by all of them
+through the page cache, and keeps only the entries of the segments (the recent writes) in a dict.
+A lookup costs one os.stat(), one dict access and a binary search of the index, no matter how large the cache gets,
+and a worker starts without reading the whole cache. The sealed segments can be merged by hand,
+and the index made again from cache.txt (e.g. after it was edited or restored) under canonical URLs, with:
+    python cache.py compact /path/to/cache.txt
+    python cache.py reindex /path/to/cache.txt
+
+'sqlite' - an SQLite database in WAL mode keyed by (URL, channel). Readers do not block on writers
+and concurrent writes from all uwsgi workers are serialized by SQLite itself.
+The existing cache.txt can be imported once with:
+    python cache.py import /path/to/cache.txt /path/to/cache.db"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from segments import (CacheWriter, LEGACY_CHANNELS, canonical_entries, compact, index_path, parse_entry, parse_line,
+                      read_entries, segment_paths)
+from sorted_index import SortedIndex, key_hash
+
+
+class _Replaced(Exception):
+    """A file of the cache was replaced or truncated behind the index."""
+
+
+class CacheIndex:
+    """Lookups in the sorted index of the compacted cache and in the entries of the segments (the delta).
+
+    At startup the index is mapped (made from cache.txt first if there is none) and the segments are read,
+    then only the active segment is watched: its size, mtime and inode are remembered after each read
+    and only its new tail is parsed. A marker line in it (SEALED or COMPACTED) makes the index read
+    the segments that follow, or map the new index and read the segments again.
+    If the watched file is replaced or shrinks (rotation, truncation by hand), the delta is rebuilt from scratch.
+    New bitlinks are in the delta at once and written to the active segment by the write-behind writer."""
+
+    def __init__(self, path, flush_entries=100, flush_interval=0.2, segment_size=16 * 2 ** 20, compact_interval=60,
+                 canonical=None):
+        self.path = path
+        self.canonical = canonical
+        self.index = None
+        self.entries = {}
+        self._lock = threading.Lock()
+        #[path, inode, size, mtime, offset] of the segments read, in order; the last one is active
+        self._files = []
+        self.writer = CacheWriter(path, flush_entries, flush_interval, segment_size, compact_interval)
+        self.refresh()
+
+    def refresh(self):
+        """Bring the index and the delta up to date with the files on disk."""
+
+        with self._lock:
+            try:
+                if self._files and not self._read_tail(self._files[-1], self.entries):
+                    return
+                #A marker line: read the new segments, unless the index was made again
+                if self._files and os.stat(index_path(self.path)).st_ino == self.index.inode:
+                    self._read_new_segments()
+                    return
+            except (_Replaced, FileNotFoundError):
+                pass
+            self._rebuild()
+
+    def _read_new_segments(self):
+        known = set(state[0] for state in self._files)
+        for path in segment_paths(self.path):
+            if path not in known:
+                state = [path, None, 0, None, 0]
+                self._read_tail(state, self.entries)
+                self._files.append(state)
+
+    def _rebuild(self):
+        while True:
+            #Segments are listed before the index is opened: a compaction replaces the index
+            #before it removes the merged segments, so none of them is missed
+            segments = segment_paths(self.path)
+            try:
+                index = self._open_index()
+                entries, files = {}, []
+                for path in segments:
+                    state = [path, None, 0, None, 0]
+                    self._read_tail(state, entries)
+                    files.append(state)
+                break
+            except (_Replaced, FileNotFoundError):
+                continue
+
+        #Entries of this worker that are still buffered
+        for url, bitlinks in self.writer.pending():
+            entries.setdefault(url, {}).update(bitlinks)
+        self.index, self.entries, self._files = index, entries, files
+
+    def _open_index(self):
+        try:
+            return SortedIndex(index_path(self.path))
+        except (FileNotFoundError, ValueError):
+            compact(self.path, rebuild=True, canonical=self.canonical, if_missing=True)
+            return SortedIndex(index_path(self.path))
+
+    def _read_tail(self, state, entries):
+        """Parse the lines appended to a segment since it was read. Returns True if a marker line was read."""
+
+        path, inode, size, mtime, offset = state
+        stat = os.stat(path)
+        if stat.st_ino == inode and stat.st_size == size and stat.st_mtime == mtime:
+            return False
+        if inode is not None and (stat.st_ino != inode or stat.st_size < offset):
+            raise _Replaced(path)
+
+        with open(path, 'rb') as in_stream:
+            in_stream.seek(offset)
+            data = in_stream.read()
+
+        #Every line ends with a line break: what follows the last one is still being written, it is read next time
+        complete = data.rfind(b'\n') + 1
+        marker = False
+        for line in data[:complete].split(b'\n'):
+            if not parse_line(entries, line):
+                marker = True
+        offset += complete
+
+        state[1:] = [stat.st_ino, stat.st_size, stat.st_mtime, offset]
+        return marker
+
+    def get(self, url):
+        """Return the dictionary {channel: bitlink} for the URL or None."""
+
+        self.refresh()
+        bitlinks = None
+        for value in self.index.find(key_hash(url)):
+            found_url, found = parse_entry(value)
+            if found_url == url:
+                bitlinks = found
+                break
+        #Recent bitlinks of the delta supersede the compacted ones
+        recent = self.entries.get(url)
+        if recent:
+            bitlinks = dict(bitlinks or {}, **recent)
+        return bitlinks
+
+    def add(self, url, bitlinks, written=None):
+        """Add bitlinks {channel: bitlink} for the URL to the delta; they are written to the active segment in the background.
+        written(), if given, is called by the writer once they are on disk (other workers find them from then on)."""
+
+        self.add_many([(url, bitlinks)], written)
+
+    def add_many(self, items, written=None):
+        """Add a batch of (url, {channel: bitlink}) pairs."""
+
+        items = list(items)
+        with self._lock:
+            for url, bitlinks in items:
+                self.entries.setdefault(url, {}).update(bitlinks)
+        for number, (url, bitlinks) in enumerate(items, 1):
+            #The pairs are written in order, the last one written means all of them are
+            self.writer.add(url, bitlinks, written if number == len(items) else None)
+        if not items and written is not None:
+            written()
+
+    def close(self):
+        """Write the buffered bitlinks and stop the writer."""
+
+        self.writer.close()
+
+
+class SqliteCache:
+    """Cache stored in an SQLite database in WAL mode.
+
+    Each thread gets its own connection. WAL lets readers work while another process writes,
+    and busy_timeout makes concurrent writers wait for each other instead of failing."""
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS channel_bitlinks (
+                url TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                bitlink TEXT NOT NULL,
+                PRIMARY KEY (url, channel)
+            ) WITHOUT ROWID''')
+
+            #Move rows of the old table with one column per channel
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bitlinks'").fetchone():
+                for column, channel in zip(('bitlink_telegram', 'bitlink_vk', 'bitlink_instagram'), LEGACY_CHANNELS):
+                    connection.execute(
+                        'INSERT OR IGNORE INTO channel_bitlinks (url, channel, bitlink) SELECT url, ?, %s FROM bitlinks' % column,
+                        (channel,),
+                    )
+                connection.execute('DROP TABLE bitlinks')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, url):
+        """Return the dictionary {channel: bitlink} for the URL or None."""
+
+        rows = self._connection().execute('SELECT channel, bitlink FROM channel_bitlinks WHERE url = ?', (url,)).fetchall()
+        return dict(rows) if rows else None
+
+    def add(self, url, bitlinks, written=None):
+        """Insert or update bitlinks {channel: bitlink} for the URL. written(), if given, is called once they are committed."""
+
+        self.add_many([(url, bitlinks)], written)
+
+    def add_many(self, items, written=None):
+        """Upsert a batch of (url, {channel: bitlink}) pairs in one transaction."""
+
+        with self._connection() as connection:
+            connection.executemany(
+                '''INSERT INTO channel_bitlinks (url, channel, bitlink) VALUES (?, ?, ?)
+                ON CONFLICT(url, channel) DO UPDATE SET bitlink = excluded.bitlink''',
+                ((url, channel, bitlink) for url, bitlinks in items for channel, bitlink in bitlinks.items()),
+            )
+        if written is not None:
+            written()
+
+    def close(self):
+        """Nothing to do: every write is committed at once."""
+
+
+class TTLCache:
+    """Small in-memory cache whose entries expire after ttl seconds.
+
+    At most maxsize entries are kept, the least recently stored ones are dropped first."""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the stored value or None if there is none or it has expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def open_cache(backend, cache_file, cache_db, **file_options):
+    """Create the cache store selected in settings. file_options go to CacheIndex (the write-behind writer)."""
+
+    if backend == 'file':
+        return CacheIndex(cache_file, **file_options)
+    if backend == 'sqlite':
+        return SqliteCache(cache_db)
+    raise ValueError('Unknown cache backend: %s' % backend)
+
+
+def import_cache_file(cache_file, store, canonical=None, batch_size=1000):
+    """One-time import of cache.txt (and its segments) into another store, in batches. Returns the number of entries.
+    With canonical(url) the entries are imported under the canonical form of their URLs."""
+
+    entries = {}
+    for path in [cache_file] + segment_paths(cache_file):
+        read_entries(path, entries)
+    if canonical is not None:
+        entries = canonical_entries(entries, canonical)
+    items = list(entries.items())
+    for start in range(0, len(items), batch_size):
+        store.add_many(items[start:start + batch_size])
+    return len(items)
+
+
+def settings_canonical():
+    """canonical(url) with the settings of the web service, for the commands below."""
+
+    import settings
+    from normalize import normalize_url
+
+    return lambda url: normalize_url(url, settings.TRACKING_PARAMS, settings.TRACKING_PREFIXES, settings.STRIP_TRAILING_SLASH)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == 'compact':
+        print('Merged %d segments' % compact(sys.argv[2]))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'reindex':
+        compact(sys.argv[2], rebuild=True, canonical=settings_canonical())
+        print('Indexed %d URLs' % len(SortedIndex(index_path(sys.argv[2]))))
+    elif len(sys.argv) == 4 and sys.argv[1] == 'import':
+        print('Imported %d entries' % import_cache_file(sys.argv[2], SqliteCache(sys.argv[3]), settings_canonical()))
+    else:
+        sys.exit('Usage: python cache.py import /path/to/cache.txt /path/to/cache.db\n'
+                 '       python cache.py compact /path/to/cache.txt\n'
+                 '       python cache.py reindex /path/to/cache.txt')
@@ -0,0 +1,148 @@
+"""Check of the rate-limit governor (governor.py) against the local fake Bitly (fakes.py).
+
+Scripted failures of the fake show that the governor waits as long as a 429 asks with Retry-After,
+retries 5xx answers with backoff, takes no more than its token bucket allows, opens the circuit
+after failures in a row (calls then fail without reaching Bitly) and closes it after the cooldown,
+once a probe has reached Bitly.
+Run before a release (or in CI), it fails with exit code 1 if any case does not behave:
+    python check_governor.py"""
+
+import os
+import sys
+import tempfile
+import time
+
+from bitly_client import BitlyClient, BitlyError
+from fakes import FakeBitly
+from governor import CircuitOpen, Governor, RateLimited
+
+URL = 'https://example.com/article'
+
+
+def governor(fake, directory, **options):
+    """Governor with its own state file around a client of the fake."""
+
+    state_path = os.path.join(directory, '%d.state' % len(os.listdir(directory)))
+    return Governor(BitlyClient('token', fake.url, connect_timeout=1, read_timeout=2), state_path, **options)
+
+
+def check_retry_after(fake, directory):
+    """A 429 with Retry-After: 1 is retried after a second, and succeeds."""
+
+    limited = governor(fake, directory, attempts=2, backoff=0.01)
+    fake.script((429, 1))
+    started = time.time()
+    limited.shorten(URL)
+    waited = time.time() - started
+    stats = limited.stats()
+    limited.close()
+    assert waited >= 1, 'retried after %.2f s, Retry-After asked for 1 s' % waited
+    assert stats['retries'] == 1 and stats['circuit'] == 'closed', stats
+
+
+def check_backoff(fake, directory):
+    """5xx answers are retried with backoff until one succeeds, and a success resets the failures."""
+
+    retried = governor(fake, directory, attempts=3, backoff=0.05)
+    fake.script(503, 502)
+    requests = fake.requests
+    retried.shorten(URL)
+    stats = retried.stats()
+    retried.close()
+    assert fake.requests - requests == 3, 'sent %d requests for 2 failures' % (fake.requests - requests)
+    assert stats['retries'] == 2 and stats['failures'] == 0, stats
+
+
+def check_bucket(fake, directory):
+    """With the bucket empty a call that may not wait is refused without being sent."""
+
+    bucket = governor(fake, directory, rate=0.5, burst=1, max_wait=0.5)
+    bucket.shorten(URL)
+    requests = fake.requests
+    try:
+        bucket.shorten(URL)
+    except RateLimited:
+        pass
+    else:
+        raise AssertionError('a call over the rate limit was sent')
+    stats = bucket.stats()
+    bucket.close()
+    assert fake.requests == requests, 'the refused call reached Bitly'
+    assert stats['rate_limited'] == 1, stats
+
+
+def check_breaker(fake, directory):
+    """After failures in a row calls fail fast without reaching Bitly; after the cooldown a probe closes the circuit."""
+
+    breaker = governor(fake, directory, attempts=1, failures=2, cooldown=1)
+    fake.script(503, 503)
+    for _ in range(2):
+        try:
+            breaker.shorten(URL)
+        except CircuitOpen:
+            raise AssertionError('the circuit opened before %d failures' % breaker.failures)
+        except BitlyError:
+            pass
+    assert breaker.stats()['circuit'] == 'open', breaker.stats()
+
+    requests = fake.requests
+    try:
+        breaker.shorten(URL)
+    except CircuitOpen:
+        pass
+    else:
+        raise AssertionError('a call went through the open circuit')
+    assert fake.requests == requests, 'a call reached Bitly while the circuit was open'
+
+    time.sleep(1.1)
+    breaker.shorten(URL)
+    stats = breaker.stats()
+    breaker.close()
+    assert stats['circuit'] == 'closed' and stats['fast_failed'] == 1, stats
+
+
+def check_half_open_rate_limited(fake, directory):
+    """A call refused by the bucket after the cooldown is not the probe: the circuit stays half-open for the next call."""
+
+    breaker = governor(fake, directory, rate=0.5, burst=1, max_wait=0.2, attempts=1, failures=1, cooldown=0.5)
+    fake.script(503)
+    try:
+        breaker.shorten(URL)
+    except BitlyError:
+        pass
+    time.sleep(0.6)
+    try:
+        breaker.shorten(URL)
+    except RateLimited:
+        pass
+    else:
+        raise AssertionError('a call over the rate limit was sent')
+    stats = breaker.stats()
+    breaker.close()
+    assert stats['circuit'] == 'half-open', 'the circuit is %s after a call that did not probe Bitly' % stats['circuit']
+
+
+CHECKS = (check_retry_after, check_backoff, check_bucket, check_breaker, check_half_open_rate_limited)
+
+
+def main():
+    fake = FakeBitly().start()
+    failed = 0
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for check in CHECKS:
+                try:
+                    check(fake, directory)
+                except AssertionError as error:
+                    failed += 1
+                    print('%s: FAILED - %s' % (check.__name__, error))
+                else:
+                    print('%s: ok' % check.__name__)
+    finally:
+        fake.stop()
+    if failed:
+        sys.exit('%d of %d governor checks failed' % (failed, len(CHECKS)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Check that the Bitly client keeps its connections alive, against the local fake Bitly (fakes.py).
+
+Many shorten() calls from the threads of the shared pool, as the web service makes them, must open
+no more TCP connections than the client pools (pool_size), and later calls must reuse them.
+Run before a release (or in CI), it fails with exit code 1 if more connections are opened:
+    python check_keepalive.py"""
+
+import sys
+
+from bitly_client import BitlyClient
+from executor import Executor
+from fakes import FakeBitly
+
+POOL_SIZE = 4
+CALLS = 200
+
+
+def check_keepalive(fake):
+    """Return the lines describing what went wrong (none if the connections are reused)."""
+
+    client = BitlyClient('token', fake.url, pool_size=POOL_SIZE)
+    executor = Executor(POOL_SIZE, CALLS)
+    problems = []
+    try:
+        for round_number in range(2):
+            futures = [executor.submit(client.shorten, 'https://example.com/%d/%d' % (round_number, number))
+                       for number in range(CALLS)]
+            results = [future.result() for future in futures]
+            if any(not result.get('url') for result in results):
+                problems.append('round %d: a call did not return a bitlink' % round_number)
+            print('round %d: %d calls, %d connections opened by the client, %d accepted by the fake' % (
+                round_number, CALLS, client.connections_opened, fake.connections))
+    finally:
+        executor.shutdown()
+        client.close()
+
+    if fake.connections > POOL_SIZE:
+        problems.append('%d connections for %d threads, at most %d expected' % (fake.connections, POOL_SIZE, POOL_SIZE))
+    if client.connections_opened != fake.connections:
+        problems.append('the client counted %d connections, the fake %d' % (client.connections_opened, fake.connections))
+    return problems
+
+
+def main():
+    fake = FakeBitly().start()
+    try:
+        problems = check_keepalive(fake)
+    finally:
+        fake.stop()
+    for line in problems:
+        print('FAILED - ' + line)
+    if problems:
+        sys.exit('Connections to Bitly are not kept alive')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Long-lived thread pool shared by all requests of a uwsgi worker.
+
+Threads are started once instead of building and joining a new pool on every cache miss.
+The number of waiting tasks is bounded: when the queue is full, submit() raises Busy
+instead of letting requests pile up behind a slow https://bitly.com/."""
+
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+_shutdown_hooks = []
+
+
+def at_shutdown(hook):
+    """Run hook when the worker stops (uwsgi reload or interpreter exit)."""
+
+    if not _shutdown_hooks:
+        if uwsgi is not None:
+            uwsgi.atexit = _run_shutdown_hooks
+        else:
+            atexit.register(_run_shutdown_hooks)
+    _shutdown_hooks.append(hook)
+
+
+def _run_shutdown_hooks():
+    while _shutdown_hooks:
+        _shutdown_hooks.pop()()
+
+
+class Busy(Exception):
+    """The executor queue is full."""
+
+
+class Executor:
+    """Bounded thread pool with counters of active, queued, completed and rejected tasks."""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.active, self.queued, self.completed, self.rejected = 0, 0, 0, 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bitlinks')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args) and return a Future. Raises Busy if the queue is full."""
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Busy('Too many tasks are waiting for the thread pool')
+
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                self._slots.release()
+
+        def forget():
+            with self._lock:
+                self.queued -= 1
+            self._slots.release()
+
+        try:
+            future = self._pool.submit(run)
+        except RuntimeError:
+            forget()
+            raise
+        #Tasks cancelled on shutdown never run, give their slots back
+        future.add_done_callback(lambda future: future.cancelled() and forget())
+        return future
+
+    def stats(self):
+        """Current state of the pool, to size it to the traffic."""
+
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'queued': self.queued,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        """Finish running tasks, drop the queued ones and stop the threads."""
+
+        self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,164 @@
+"""Local stand-ins for https://bitly.com/ and for the website, to try and measure the service without the real ones.
+
+Run it and point BITLY_API in settings.py at it:
+    python fakes.py 8081
+    BITLY_API = 'http://127.0.0.1:8081'
+
+Or start it from Python with FakeBitly().start() - it serves in a background thread
+and counts requests and TCP connections, e.g. to see that connections are kept alive.
+
+Failures can be scripted: the next answers are taken from the script before normal service resumes,
+e.g. fake.script(429, (429, 2), 503) - a 429, a 429 with Retry-After: 2, a 503. From the command line:
+    python fakes.py 8081 429 429:2 503
+
+Both fakes can answer with a delay (latency, seconds), like the real services over the Internet.
+FakeOrigin is a website whose pages all exist (200 OK), except those under /missing (404 Not Found)."""
+
+import collections
+import hashlib
+import json
+import sys
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class _BitlyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def do_GET(self):
+        fake = self.server.fake
+        with fake.lock:
+            fake.requests += 1
+            answer = fake.scripted.popleft() if fake.scripted else None
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if answer is not None:
+            status, retry_after = answer
+            headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+            return self._send(status, {'status_code': status, 'status_txt': HTTPStatus(status).phrase, 'data': None}, headers)
+
+        request = urlsplit(self.path)
+        params = parse_qs(request.query)
+        if request.path != '/v3/shorten' or 'longUrl' not in params:
+            return self._send(404, {'status_code': 404, 'status_txt': 'NOT_FOUND', 'data': None})
+
+        long_url = params['longUrl'][0]
+        bitlink_hash = hashlib.md5(long_url.encode('utf-8')).hexdigest()[:7]
+        self._send(200, {
+            'status_code': 200,
+            'status_txt': 'OK',
+            'data': {'url': 'http://bit.ly/' + bitlink_hash, 'hash': bitlink_hash, 'long_url': long_url},
+        })
+
+    def _send(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._send(with_body=False)
+
+    def do_GET(self):
+        self._send(with_body=True)
+
+    def _send(self, with_body):
+        fake = self.server.fake
+        with fake.lock:
+            fake.requests += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        status = 404 if self.path.startswith('/missing') else 200
+        body = ('<html><body>%s</body></html>' % HTTPStatus(status).phrase).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _FakeServer:
+    """Threaded HTTP/1.1 server on a local port (0 - any free port), serving in a background thread after start()."""
+
+    handler = None
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeBitly(_FakeServer):
+    """Bitly API v3 /v3/shorten on a local port. Bitlinks are derived from a hash of the long URL."""
+
+    handler = _BitlyHandler
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.connections = 0
+        self.scripted = collections.deque()
+        super().__init__(host, port, latency)
+
+    def script(self, *answers):
+        """Answer the next requests with these errors: a status code or (status code, Retry-After seconds)."""
+
+        with self.lock:
+            for answer in answers:
+                self.scripted.append(answer if isinstance(answer, tuple) else (answer, None))
+        return self
+
+
+class FakeOrigin(_FakeServer):
+    """Website on a local port: every page exists (200 OK), except the pages under /missing (404 Not Found)."""
+
+    handler = _OriginHandler
+
+
+if __name__ == "__main__":
+    fake = FakeBitly(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    for answer in sys.argv[2:]:
+        status, _, retry_after = answer.partition(':')
+        fake.script((int(status), int(retry_after) if retry_after else None))
+    print('Fake Bitly API: ' + fake.url)
+    fake.server.serve_forever()
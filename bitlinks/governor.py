@@ -0,0 +1,192 @@
+"""Rate-limit governor around Bitly shortening, shared by all uwsgi workers.
+
+Publishing bursts must not run into Bitly's rate limits, and while Bitly is failing
+the workers must not keep hammering it. The governor wraps BitlyClient.shorten() with:
+
+    a token bucket (rate per second, burst) - calls wait for a token, or fail at once if the wait is too long;
+    Retry-After - a 429 answer pauses all workers for as long as Bitly asked;
+    retries with exponential backoff and full jitter for 429, 5xx and network errors;
+    a circuit breaker - after several failures in a row calls fail fast for a cooldown,
+    then one call probes Bitly and closes the circuit if it succeeds.
+
+The state is one small record in a file (see STATE) updated under an exclusive flock(),
+so the 5 uwsgi processes share one bucket and one breaker."""
+
+import fcntl
+import http.client
+import os
+import random
+import struct
+import threading
+import time
+
+from bitly_client import BitlyError
+
+#tokens, time of the last refill, paused until (Retry-After), circuit open until, failures in a row
+STATE = struct.Struct('<ddddd')
+
+
+class RateLimited(BitlyError):
+    """No token within the allowed wait: the call is not sent."""
+
+    def __init__(self, wait):
+        super().__init__(429, 'Too many links are being shortened, next slot in %.1f s' % wait, wait)
+
+
+class CircuitOpen(BitlyError):
+    """Bitly is failing: calls are not sent until the cooldown is over."""
+
+    def __init__(self, wait):
+        super().__init__(503, 'Bitly is not available, next try in %d s' % max(1, wait), wait)
+
+
+class SharedState:
+    """The governor record in a file, read and written under flock() (between workers) and a lock (between threads)."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+        self._lock = threading.Lock()
+
+    def update(self, change):
+        """Call change(state) with the state as a list (changes are written back) and return its result."""
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self._fd, STATE.size, 0)
+                state = list(STATE.unpack(data)) if len(data) == STATE.size else [0.0] * 5
+                result = change(state)
+                os.pwrite(self._fd, STATE.pack(*state), 0)
+                return result
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class Governor:
+    """BitlyClient with a shared token bucket, Retry-After, jittered backoff and a circuit breaker.
+
+    max_wait bounds the time one shorten() call may spend waiting for tokens and between attempts."""
+
+    def __init__(self, client, state_path, rate=5, burst=10, attempts=3, backoff=0.5, max_wait=5,
+                 failures=5, cooldown=30):
+        self.client = client
+        self.rate, self.burst = rate, burst
+        self.attempts, self.backoff, self.max_wait = attempts, backoff, max_wait
+        self.failures, self.cooldown = failures, cooldown
+        self.retries, self.rate_limited, self.fast_failed = 0, 0, 0
+        self._state = SharedState(state_path)
+        self._lock = threading.Lock()
+
+    def shorten(self, long_url):
+        """Shorten the URL like BitlyClient.shorten(), within the rate limit and the circuit breaker."""
+
+        deadline = time.time() + self.max_wait
+        for attempt in range(self.attempts):
+            self._acquire(deadline)
+            try:
+                result = self.client.shorten(long_url)
+            except (BitlyError, OSError, http.client.HTTPException, ValueError) as error:
+                if isinstance(error, BitlyError) and not (error.rate_limited or error.temporary):
+                    #Bitly works, the request is wrong: retrying will not help
+                    self._state.update(self._succeeded)
+                    raise
+                delay = self._failed(error, attempt)
+                if attempt + 1 == self.attempts or time.time() + delay > deadline:
+                    raise
+            else:
+                self._state.update(self._succeeded)
+                return result
+
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+
+    def _acquire(self, deadline):
+        """Take a token, waiting for it if needed. Raises CircuitOpen or RateLimited instead of waiting too long."""
+
+        def take(state):
+            tokens, updated, paused_until, open_until, failures = state
+            now = time.time()
+            if failures >= self.failures and now < open_until:
+                return CircuitOpen(open_until - now)
+
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = max(paused_until - now, 0, (1 - tokens) / self.rate)
+            if now + wait > deadline:
+                state[0], state[1] = tokens, now
+                return RateLimited(wait)
+            #The token is reserved now and used after the wait, so the bucket may go below zero
+            state[0], state[1] = tokens - 1, now
+            if failures >= self.failures:
+                #Half-open: this call probes Bitly, the others keep failing fast until it answers
+                state[3] = now + self.cooldown
+            return wait
+
+        result = self._state.update(take)
+        if isinstance(result, BitlyError):
+            with self._lock:
+                if isinstance(result, CircuitOpen):
+                    self.fast_failed += 1
+                else:
+                    self.rate_limited += 1
+            raise result
+        if result > 0:
+            time.sleep(result)
+
+    def _failed(self, error, attempt):
+        """Record a failed call and return the delay before the next attempt."""
+
+        retry_after = getattr(error, 'retry_after', None)
+        backoff = random.uniform(0, self.backoff * 2 ** attempt)
+
+        def record(state):
+            now = time.time()
+            if getattr(error, 'rate_limited', False):
+                #Bitly is up but wants a pause: all workers wait, the breaker is not involved
+                state[2] = max(state[2], now + (retry_after if retry_after is not None else backoff))
+                state[4] = 0
+            else:
+                state[4] += 1
+                if state[4] >= self.failures:
+                    state[3] = now + self.cooldown
+
+        self._state.update(record)
+        return max(retry_after or 0, backoff)
+
+    @staticmethod
+    def _succeeded(state):
+        state[3], state[4] = 0, 0
+
+    def is_open(self):
+        """Whether calls fail fast now because Bitly was failing."""
+
+        return self._state.update(lambda state: state[4] >= self.failures and time.time() < state[3])
+
+    def stats(self):
+        """State of the bucket and the breaker (shared) and counters of this worker (JSON-friendly)."""
+
+        def read(state):
+            now = time.time()
+            tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            if state[4] < self.failures:
+                circuit = 'closed'
+            else:
+                circuit = 'open' if now < state[3] else 'half-open'
+            return {'tokens': round(tokens, 2), 'paused_for': round(max(0, state[2] - now), 2),
+                    'circuit': circuit, 'failures': int(state[4])}
+
+        stats = self._state.update(read)
+        with self._lock:
+            stats.update(retries=self.retries, rate_limited=self.rate_limited, fast_failed=self.fast_failed)
+        return stats
+
+    def close(self):
+        """Close the client's connections and the state file."""
+
+        self.client.close()
+        self._state.close()
@@ -0,0 +1,132 @@
+"""Pool of persistent HTTP/1.1 connections to one host, shared by the threads of a uwsgi worker."""
+
+import http.client
+import queue
+import socket
+import threading
+import time
+
+#Errors meaning that a kept-alive connection was closed by the server while it was idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class _Deadline:
+    """Shuts the connection down when the deadline passes, waking up a thread blocked reading it
+    (a server that sends its answer slowly passes every read timeout)."""
+
+    def __init__(self, connection, seconds):
+        self.expired = False
+        self._connection = connection
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            if self._connection is None:
+                return
+            self.expired = True
+            try:
+                self._connection.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+    def cancel(self):
+        """Disarm the timer. Returns True if the deadline passed first."""
+
+        self._timer.cancel()
+        with self._lock:
+            self._connection = None
+            return self.expired
+
+
+class ConnectionPool:
+    """LIFO pool of kept-alive connections with separate connect and read timeouts."""
+
+    def __init__(self, scheme, host, port=None, size=12, connect_timeout=3, read_timeout=10):
+        self._connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self.host, self.port = host, port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connections_opened = 0
+        self._pool = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+
+    def get(self, timeout=None):
+        """Return (connection, reused). A new connection is opened if none is idle.
+
+        timeout, if given, caps both the connect and the read timeout (e.g. to meet a deadline)."""
+
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        if timeout is not None:
+            connect_timeout, read_timeout = min(connect_timeout, timeout), min(read_timeout, timeout)
+
+        try:
+            connection, reused = self._pool.get_nowait(), True
+        except queue.Empty:
+            connection = self._connection_class(self.host, self.port, timeout=connect_timeout)
+            connection.connect()
+            with self._lock:
+                self.connections_opened += 1
+            reused = False
+
+        connection.sock.settimeout(read_timeout)
+        return connection, reused
+
+    def request(self, method, path, headers=None, deadline=None, read_body=True):
+        """Send the request on a pooled connection and return (response, body).
+
+        A kept-alive connection may have been closed by the server meanwhile: the request is retried once on a new one.
+        deadline (time.monotonic()) caps the whole request, however slowly the server answers: socket.timeout is raised
+        when it passes. Without read_body only the headers are read, body is None and the connection is closed;
+        otherwise it goes back to the pool unless the server closes it."""
+
+        for attempt in range(2):
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise socket.timeout('Deadline exceeded')
+
+            connection, reused = self.get(timeout)
+            watch = _Deadline(connection, deadline - time.monotonic()) if deadline is not None else None
+            try:
+                try:
+                    connection.request(method, path, headers=headers or {})
+                    response = connection.getresponse()
+                    body = response.read() if read_body else None
+                finally:
+                    if watch is not None and watch.cancel():
+                        raise socket.timeout('Deadline exceeded')
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            if read_body and not response.will_close:
+                self.put(connection)
+            else:
+                connection.close()
+            return response, body
+
+    def put(self, connection):
+        """Give the connection back to the pool, or close it if the pool is full."""
+
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
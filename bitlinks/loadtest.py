@@ -0,0 +1,295 @@
+"""End-to-end load test of the service against a local fake Bitly and a fake website.
+
+Starts the app from wsgi.py on a local port (threaded WSGI server) with a temporary cache,
+a FakeBitly and a FakeOrigin (see fakes.py) with the given latency, warms the cache,
+then sends a mix of /bitlinks/go, /bitlinks/ajax and /bitlinks/nojs requests at every concurrency level
+and reports throughput and p50 / p95 / p99 latency, in total and per route:
+
+    python loadtest.py --requests 2000 --concurrency 1,8,32 --hit-ratio 0.8 --missing 0.05 --bitly-latency 0.15
+
+The same requests can be sent again, e.g. before and after a change:
+
+    python loadtest.py --record requests.log
+    python loadtest.py --replay requests.log --concurrency 8 --json after.json
+
+A replayed log is one request per line: "GET /bitlinks/go?url=..." or "POST /bitlinks/ajax url=...".
+Lines of an nginx access log are read too (POST bodies are not in it, so those requests are skipped).
+A log is sent whole at every concurrency level, so its cache misses are misses only at the first level.
+The URLs of replayed requests are moved to the fake website (path and query are kept), so nothing leaves the machine.
+
+With --target the requests go to a running service instead (e.g. uwsgi with all its workers).
+It must use the fakes as its Bitly API and website: python fakes.py 8081 for Bitly, and --origin for the website."""
+
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
+
+import settings
+from fakes import FakeBitly, FakeOrigin
+
+ROUTES = ('go', 'ajax', 'nojs')
+
+#Request line of an nginx access log: "GET /bitlinks/go?url=... HTTP/1.1"
+ACCESS_LOG_REQUEST = re.compile(r'"(GET|POST) (/bitlinks/\S*) HTTP/[\d.]+"')
+
+
+def start_service(bitly_latency, origin_latency, bitly_rate):
+    """Start the fakes and the app from wsgi.py with a temporary cache. Returns (service URL, website URL)."""
+
+    from werkzeug.serving import make_server
+
+    bitly = FakeBitly(latency=bitly_latency).start()
+    origin = FakeOrigin(latency=origin_latency).start()
+
+    directory = tempfile.mkdtemp(prefix='bitlinks-loadtest-')
+    settings.CACHE_FILE = os.path.join(directory, 'cache.txt')
+    settings.CACHE_DB = os.path.join(directory, 'cache.db')
+    settings.LOCK_DIR = os.path.join(directory, 'locks')
+    settings.BITLY_STATE = os.path.join(directory, 'locks', 'bitly.state')
+    settings.METRICS_DIR = os.path.join(directory, 'metrics')
+    settings.BITLY_API = bitly.url
+    settings.BITLY_RATE = settings.BITLY_BURST = bitly_rate
+    settings.YOUR_WEBSITE = origin.url
+    #Sampled timing lines would mix with the report; the Server-Timing header is still sent
+    settings.TIMING_LOG_SAMPLE = 0
+
+    #Imported only now: the app reads the settings when it is imported
+    from wsgi import app
+
+    #The access log of the server would cost more than the requests
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_port, origin.url
+
+
+def request_line(route, url):
+    """The request for a route and a page as a log line."""
+
+    if route == 'ajax':
+        return 'POST /bitlinks/ajax ' + urlencode({'url': url})
+    return 'GET /bitlinks/%s?%s' % (route, urlencode({'url': url}))
+
+
+def generate(count, mix, hit_ratio, missing, pages, origin, seed):
+    """Yield log lines of a random mix of requests.
+
+    hit_ratio of the requests are for `pages` pages that are cached beforehand (see warm_lines),
+    `missing` of them are for pages that do not exist (404), the rest are for new pages (cache misses)."""
+
+    rng = random.Random(seed)
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    for number in range(count):
+        chance = rng.random()
+        if chance < hit_ratio:
+            path = '/page-%d' % rng.randrange(pages)
+        elif chance < hit_ratio + missing:
+            path = '/missing/%d-%d' % (seed, number)
+        else:
+            path = '/new-%d-%d' % (seed, number)
+        yield request_line(rng.choices(routes, weights)[0], origin + path)
+
+
+def warm_lines(pages, origin):
+    """Log lines that put the pages of the hit part of the mix into the cache."""
+
+    return [request_line('ajax', '%s/page-%d' % (origin, page)) for page in range(pages)]
+
+
+def read_log(path):
+    """Yield the requests of a recorded log or of an nginx access log as log lines."""
+
+    with open(path) as in_stream:
+        for line in in_stream:
+            line = line.strip()
+            found = ACCESS_LOG_REQUEST.search(line)
+            if found:
+                if found.group(1) == 'GET':
+                    yield 'GET ' + found.group(2)
+            elif line.startswith(('GET ', 'POST ')):
+                yield line
+
+
+def to_origin(line, origin):
+    """Move the requested URL of a log line to the fake website, keeping its path and query."""
+
+    def move(query):
+        params = []
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name == 'url':
+                parts = urlsplit(value)
+                value = urlunsplit(urlsplit(origin)[:2] + (parts.path or '/', parts.query, ''))
+            params.append((name, value))
+        return urlencode(params)
+
+    method, _, rest = line.partition(' ')
+    path, _, body = rest.partition(' ')
+    path, _, query = path.partition('?')
+    return ' '.join(part for part in (method, path + ('?' + move(query) if query else ''), move(body) if body else '') if part)
+
+
+def run(target, lines, concurrency):
+    """Send the requests with `concurrency` kept-alive connections. Returns [(route, status, seconds)]."""
+
+    parts = urlsplit(target)
+    lines = iter(lines)
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        while True:
+            with lock:
+                line = next(lines, None)
+            if line is None:
+                break
+            method, _, rest = line.partition(' ')
+            path, _, body = rest.partition(' ')
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'} if method == 'POST' else {}
+            route = urlsplit(path).path.rsplit('/', 1)[-1]
+
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body or None, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status = 0
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                results.append((route, status, elapsed))
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of sorted values."""
+
+    if not ordered:
+        return 0
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(results, seconds, concurrency):
+    """Throughput and latency percentiles (milliseconds) in total and per route."""
+
+    def latency(items):
+        ordered = sorted(elapsed for _, _, elapsed in items)
+        return {
+            'count': len(ordered),
+            'errors': sum(1 for _, status, _ in items if status == 0 or status >= 500),
+            'p50': round(percentile(ordered, 0.50) * 1000, 2),
+            'p95': round(percentile(ordered, 0.95) * 1000, 2),
+            'p99': round(percentile(ordered, 0.99) * 1000, 2),
+        }
+
+    routes = {route: latency([item for item in results if item[0] == route])
+              for route in sorted(set(route for route, _, _ in results))}
+    return dict(concurrency=concurrency, seconds=round(seconds, 3), throughput=round(len(results) / seconds, 1),
+                total=latency(results), routes=routes)
+
+
+def report(summary):
+    print('concurrency %d: %d requests in %.2f s, %.1f requests/s, %d errors' % (
+        summary['concurrency'], summary['total']['count'], summary['seconds'], summary['throughput'],
+        summary['total']['errors']))
+    print('    %-6s %7s %9s %9s %9s' % ('route', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, stats in itertools.chain([('all', summary['total'])], summary['routes'].items()):
+        print('    %-6s %7d %9.2f %9.2f %9.2f' % (route, stats['count'], stats['p50'], stats['p95'], stats['p99']))
+
+
+def parse_mix(value):
+    """'go=60,ajax=30,nojs=10' -> {'go': 60, 'ajax': 30, 'nojs': 10}"""
+
+    mix = {}
+    for item in value.split(','):
+        route, _, weight = item.partition('=')
+        if route.strip() not in ROUTES:
+            raise argparse.ArgumentTypeError('unknown route: %s' % route)
+        mix[route.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the service with a local fake Bitly and website.')
+    parser.add_argument('--requests', type=int, default=1000, help='requests at every concurrency level')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated concurrency levels')
+    parser.add_argument('--mix', type=parse_mix, default='go=60,ajax=30,nojs=10', help='weights of the routes')
+    parser.add_argument('--hit-ratio', type=float, default=0.8, help='share of requests for cached pages')
+    parser.add_argument('--missing', type=float, default=0.05, help='share of requests for pages that do not exist')
+    parser.add_argument('--pages', type=int, default=200, help='number of cached pages')
+    parser.add_argument('--bitly-latency', type=float, default=0.1, help='delay of the fake Bitly (seconds)')
+    parser.add_argument('--origin-latency', type=float, default=0.05, help='delay of the fake website (seconds)')
+    parser.add_argument('--bitly-rate', type=float, default=1000000, help='calls per second allowed by the governor')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random mix')
+    parser.add_argument('--record', help='write the generated requests to this file instead of sending them')
+    parser.add_argument('--replay', help='send the requests of this log (one per line, or an nginx access log)')
+    parser.add_argument('--target', help='URL of a running service instead of starting the app from wsgi.py')
+    parser.add_argument('--origin', help='with --target: the website the service allows (YOUR_WEBSITE)')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    if args.record:
+        with open(args.record, 'w') as out_stream:
+            for line in generate(args.requests, args.mix, args.hit_ratio, args.missing, args.pages,
+                                 'http://127.0.0.1', args.seed):
+                out_stream.write(line + '\n')
+        return
+
+    if args.target:
+        if not args.origin:
+            parser.error('--target needs --origin')
+        target, origin = args.target.rstrip('/'), args.origin.rstrip('/')
+    else:
+        target, origin = start_service(args.bitly_latency, args.origin_latency, args.bitly_rate)
+
+    run(target, warm_lines(args.pages, origin), max(levels))
+
+    if args.replay:
+        replayed = [to_origin(line, origin) for line in read_log(args.replay)]
+        if not replayed:
+            sys.exit('No requests to replay in %s' % args.replay)
+
+    summaries = []
+    for level in levels:
+        if args.replay:
+            lines = replayed
+        else:
+            lines = generate(args.requests, args.mix, args.hit_ratio, args.missing, args.pages, origin, args.seed + level)
+        started = time.perf_counter()
+        results = run(target, lines, level)
+        summaries.append(summarize(results, time.perf_counter() - started, level))
+        report(summaries[-1])
+
+    if args.json:
+        with open(args.json, 'w') as out_stream:
+            json.dump(summaries, out_stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
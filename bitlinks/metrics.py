@@ -0,0 +1,248 @@
+"""Prometheus-style metrics of the service, aggregated across all uwsgi workers.
+
+Every worker counts in memory and writes a snapshot of its metrics to <directory>/<pid>.json
+once per `interval` seconds. A scrape of /bitlinks/metrics reads the snapshots
+of all workers and sums them, so one scrape shows the whole service.
+Counters and histograms of workers that have exited are folded into archive.json, so totals never go back;
+gauges (e.g. thread-pool occupancy) are taken from running workers only."""
+
+import fcntl
+import json
+import os
+import threading
+
+#Upper bounds of latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+ARCHIVE = 'archive.json'
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, help_text, labels):
+        self.registry, self.name, self.help, self.labels = registry, name, help_text, labels
+        self.samples = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.registry.lock:
+            self.samples[label_values] = self.samples.get(label_values, 0) + amount
+
+
+class Histogram:
+    """Histogram with labels: counts per bucket, sum and count of observed values."""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels, buckets=LATENCY_BUCKETS):
+        self.registry, self.name, self.help, self.labels = registry, name, help_text, labels
+        self.buckets = buckets
+        self.samples = {}
+
+    def observe(self, value, *label_values):
+        with self.registry.lock:
+            sample = self.samples.get(label_values)
+            if sample is None:
+                sample = self.samples[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[index] += 1
+                    break
+            sample[-2] += value
+            sample[-1] += 1
+
+
+class Gauge:
+    """Gauge read from a function when the snapshot is written: function() -> {label values: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help_text, labels, function):
+        self.registry, self.name, self.help, self.labels = registry, name, help_text, labels
+        self.function = function
+
+    @property
+    def samples(self):
+        return self.function()
+
+
+class Registry:
+    """Metrics of this worker, written to a file for the scrape."""
+
+    def __init__(self, directory, interval=1):
+        self.directory = directory
+        self.interval = interval
+        self.metrics = []
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._loop, name='bitlinks-metrics', daemon=True)
+        self._thread.start()
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, labels, function):
+        return self._add(Gauge(self, name, help_text, labels, function))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """Metrics of this worker: {name: {kind, help, labels, buckets, samples: [[label values, value]]}}."""
+
+        with self.lock:
+            counted = [(metric, list(metric.samples.items())) for metric in self.metrics if metric.kind != 'gauge']
+        #Gauges are read outside of the lock, their functions may take other locks
+        measured = [(metric, list(metric.samples.items())) for metric in self.metrics if metric.kind == 'gauge']
+
+        return {
+            metric.name: {
+                'kind': metric.kind,
+                'help': metric.help,
+                'labels': list(metric.labels),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': [[list(label_values), value] for label_values, value in samples],
+            }
+            for metric, samples in counted + measured
+        }
+
+    def flush(self):
+        """Write the snapshot of this worker (atomically, readers never see half a file)."""
+
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        write_json(path, self.snapshot())
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        """Write the last snapshot and stop the background thread."""
+
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def exposition(self):
+        """Metrics of all workers in the Prometheus text format."""
+
+        self.flush()
+        return render(collect(self.directory))
+
+
+def write_json(path, data):
+    temporary = '%s.%d.tmp' % (path, threading.get_ident())
+    with open(temporary, 'w') as out_stream:
+        json.dump(data, out_stream)
+    os.replace(temporary, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as in_stream:
+            return json.load(in_stream)
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(total, snapshot, with_gauges=True):
+    """Add the samples of a snapshot to the total (same format)."""
+
+    for name, metric in snapshot.items():
+        if metric['kind'] == 'gauge' and not with_gauges:
+            continue
+        target = total.setdefault(name, dict(metric, samples=[]))
+        samples = {tuple(label_values): value for label_values, value in target['samples']}
+        for label_values, value in metric['samples']:
+            key = tuple(label_values)
+            if key not in samples:
+                samples[key] = value
+            elif isinstance(value, list):
+                samples[key] = [old + new for old, new in zip(samples[key], value)]
+            else:
+                samples[key] += value
+        target['samples'] = [[list(key), value] for key, value in samples.items()]
+    return total
+
+
+def collect(directory):
+    """Sum the snapshots of all workers. Snapshots of exited workers are moved to the archive first."""
+
+    with open(os.path.join(directory, ARCHIVE + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        archive_path = os.path.join(directory, ARCHIVE)
+        archive = read_json(archive_path) or {}
+        total = {}
+        archived = False
+        for name in os.listdir(directory):
+            pid, _, extension = name.partition('.')
+            if extension != 'json' or not pid.isdigit():
+                continue
+            path = os.path.join(directory, name)
+            snapshot = read_json(path)
+            if snapshot is None:
+                continue
+            if is_running(int(pid)):
+                merge(total, snapshot)
+            else:
+                merge(archive, snapshot, with_gauges=False)
+                os.remove(path)
+                archived = True
+        if archived:
+            write_json(archive_path, archive)
+
+    return merge(total, archive)
+
+
+def render(metrics):
+    """Prometheus text exposition format (version 0.0.4)."""
+
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['kind']))
+        for label_values, value in sorted(metric['samples']):
+            labels = list(zip(metric['labels'], label_values))
+            if metric['kind'] != 'histogram':
+                lines.append('%s%s %s' % (name, label_text(labels), number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'], value[:-2]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, label_text(labels + [('le', number(bound))]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, label_text(labels + [('le', '+Inf')]), value[-1]))
+            lines.append('%s_sum%s %s' % (name, label_text(labels), number(value[-2])))
+            lines.append('%s_count%s %d' % (name, label_text(labels), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in labels)
+
+
+def number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,79 @@
+"""Canonical form of requested URLs.
+
+Equivalent links share one cache entry: https://Yandex.ru:443 and https://yandex.ru/ are the same page,
+and so are pages that differ only by tracking parameters (?from=..., utm_*, _openstat) or by parameter order.
+The canonical URL is the key of the cache and of the negative cache, and the base of the links with UTM tags."""
+
+from urllib.parse import urlsplit, urlunsplit, urlencode, quote_plus, unquote_plus
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def is_tracking(name, tracking_params, tracking_prefixes):
+    """Whether a query parameter is a tracking tag that must be removed."""
+
+    return name in tracking_params or name.startswith(tuple(tracking_prefixes))
+
+
+def parse_query(query):
+    """(name, value) pairs of a query string, decoded. value is None for a parameter without '=' (?flag),
+    which is kept that way: ?flag and ?flag= are different URLs for some sites."""
+
+    pairs = []
+    for field in query.split('&'):
+        if field:
+            name, equals, value = field.partition('=')
+            pairs.append((unquote_plus(name), unquote_plus(value) if equals else None))
+    return pairs
+
+
+def build_query(pairs):
+    """Query string of (name, value) pairs, the reverse of parse_query."""
+
+    return '&'.join(quote_plus(name) + ('' if value is None else '=' + quote_plus(value)) for name, value in pairs)
+
+
+def normalize_url(url, tracking_params=(), tracking_prefixes=(), strip_trailing_slash=False):
+    """Return the canonical form of the URL.
+
+    The scheme and host are lower-cased, the default port and the fragment are dropped,
+    an empty path becomes '/', tracking parameters are removed and the other parameters are sorted.
+    HTML-escaped ampersands (&amp;) in pasted links are unescaped first; no other entity is touched,
+    so parameters such as &copy=1 or &region=ru stay as they are.
+    Anything that is not an http(s) URL is returned as is (without surrounding spaces)."""
+
+    url = url.strip().replace('&amp;', '&')
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+
+    host = parts.hostname.rstrip('.')
+    if ':' in host:
+        #An IPv6 address, its brackets are dropped by hostname
+        host = '[%s]' % host
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        host += ':%d' % port
+
+    path = parts.path or '/'
+    if strip_trailing_slash and path != '/':
+        path = path.rstrip('/') or '/'
+
+    query = sorted(
+        ((name, value) for name, value in parse_query(parts.query)
+         if not is_tracking(name, tracking_params, tracking_prefixes)),
+        key=lambda pair: (pair[0], pair[1] is not None, pair[1] or ''),
+    )
+
+    return urlunsplit((scheme, host, path, build_query(query), ''))
+
+
+def add_query(url, params):
+    """Append query parameters (e.g. UTM tags) to a canonical URL."""
+
+    return url + ('&' if urlsplit(url).query else '?') + urlencode(params)
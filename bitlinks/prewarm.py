@@ -0,0 +1,129 @@
+"""Fill the cache in advance, so that nearly every /bitlinks/go is a cache hit.
+
+Reads a sitemap.xml (parsed as a stream, so large sitemaps are fine) or a plain list of URLs, one per line,
+skips URLs that are already cached and shortens the rest with the same code and cache as the web service.
+
+Example for cron:
+    python prewarm.py /var/www/sitemap.xml --concurrency 4 --rate 2
+
+Processed URLs are appended to a progress file (<input>.progress by default),
+so an interrupted run continues where it stopped."""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from bitlinks import canonical_url, cached_bitlinks, get_bitlinks, Rejected
+import settings
+
+
+class RateLimiter:
+    """Lets at most `rate` calls per second through, spacing them evenly."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def read_urls(path):
+    """Yield URLs from a sitemap.xml (<loc> elements) or from a text file with one URL per line."""
+
+    with open(path, 'rb') as in_stream:
+        is_xml = in_stream.read(512).lstrip().startswith(b'<')
+
+    if not is_xml:
+        with open(path) as in_stream:
+            for line in in_stream:
+                if line.strip():
+                    yield line.strip()
+        return
+
+    for event, element in ET.iterparse(path, events=('end',)):
+        if element.tag.rsplit('}', 1)[-1] == 'loc' and element.text:
+            yield element.text.strip()
+        #Free parsed elements, the sitemap is never held in memory as a whole
+        if element.tag.rsplit('}', 1)[-1] in ('url', 'sitemap'):
+            element.clear()
+
+
+def prewarm(urls, progress_path, concurrency=4, rate=0):
+    """Shorten all URLs that are not cached yet. Returns counters of what was done."""
+
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path) as in_stream:
+            done = set(line.strip() for line in in_stream)
+
+    counters = {'cached': 0, 'shortened': 0, 'rejected': 0, 'failed': 0}
+    limiter = RateLimiter(rate)
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    with open(progress_path, 'a') as progress:
+
+        def finish(url, result):
+            with lock:
+                counters[result] += 1
+                if result != 'failed':
+                    progress.write(url + '\n')
+                    progress.flush()
+
+        def work(url):
+            try:
+                limiter.wait()
+                bitlinks = get_bitlinks(url)
+                #A URL with a failed channel is not marked as done, the next run makes it again
+                finish(url, 'shortened' if len(bitlinks) == len(settings.CHANNELS) else 'failed')
+            except Rejected as error:
+                #Only a definite rejection (not our website, a missing page) is done, a page that did not answer is tried again
+                if error.temporary:
+                    print('%s: %s' % (url, error), file=sys.stderr)
+                finish(url, 'failed' if error.temporary else 'rejected')
+            except Exception as error:
+                print('%s: %s' % (url, error), file=sys.stderr)
+                finish(url, 'failed')
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for url in urls:
+                url = canonical_url(url)
+                if url in done:
+                    continue
+                if cached_bitlinks(url):
+                    finish(url, 'cached')
+                    continue
+                #Keep only a few URLs in flight, the input is read as a stream
+                slots.acquire()
+                pool.submit(work, url)
+
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill the bitlinks cache from a sitemap.xml or a list of URLs.')
+    parser.add_argument('input', help='sitemap.xml or a text file with one URL per line')
+    parser.add_argument('--concurrency', type=int, default=4, help='URLs shortened at the same time')
+    parser.add_argument('--rate', type=float, default=2, help='URLs per second at most (0 - no limit)')
+    parser.add_argument('--progress', help='progress file for resuming (default: <input>.progress)')
+    args = parser.parse_args()
+
+    counters = prewarm(read_urls(args.input), args.progress or args.input + '.progress', args.concurrency, args.rate)
+    print(', '.join('%s: %d' % item for item in counters.items()))
+
+
+if __name__ == "__main__":
+    main()
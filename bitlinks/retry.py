@@ -0,0 +1,103 @@
+"""Background retry of work that failed, e.g. the shortening of one channel's link.
+
+The request that hit the error answers at once with what it has; the missing part is retried here
+with growing delays, so the next request for the same URL is served from the cache."""
+
+import heapq
+import itertools
+import threading
+import time
+
+from executor import Busy
+
+
+class BackgroundRetry:
+    """Retries work(key) on the executor until it returns True, at most `attempts` times per key.
+
+    The delay doubles after every failed attempt (delay, 2 * delay, 4 * delay, ...).
+    A key has at most one pending retry in this worker: scheduling it again while it is pending does nothing.
+    counter, if given, is a metrics counter labelled by outcome: every attempt counts as 'done' or 'failed',
+    and a key dropped after its last attempt as 'given_up'."""
+
+    def __init__(self, executor, delay=5, attempts=5, counter=None):
+        self.executor = executor
+        self.delay = delay
+        self.attempts = attempts
+        self.counter = counter
+        self._queue = []
+        self._pending = set()
+        self._order = itertools.count()
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name='bitlinks-retry', daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, work):
+        """Retry work(key) in the background, unless a retry of this key is already pending."""
+
+        with self._condition:
+            if key in self._pending or self._stopped:
+                return
+            self._pending.add(key)
+            self._push(key, work, 0)
+
+    def pending(self):
+        """Number of keys waiting for a retry."""
+
+        with self._condition:
+            return len(self._pending)
+
+    def _push(self, key, work, attempt):
+        heapq.heappush(self._queue, (time.monotonic() + self.delay * 2 ** attempt, next(self._order), key, work, attempt))
+        self._condition.notify()
+
+    def _loop(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                due = self._queue[0][0] - time.monotonic()
+                if due > 0:
+                    self._condition.wait(due)
+                    continue
+                _, _, key, work, attempt = heapq.heappop(self._queue)
+                try:
+                    self.executor.submit(self._run, key, work, attempt)
+                except Busy:
+                    #The pool is full with requests, which go first: try again after the next delay
+                    self._retry_later(key, work, attempt)
+
+    def _run(self, key, work, attempt):
+        try:
+            done = work(key)
+        except Exception:
+            done = False
+
+        self._count('done' if done else 'failed')
+        with self._condition:
+            if done:
+                self._pending.discard(key)
+            else:
+                self._retry_later(key, work, attempt)
+
+    def _retry_later(self, key, work, attempt):
+        if attempt + 1 < self.attempts and not self._stopped:
+            self._push(key, work, attempt + 1)
+        else:
+            self._count('given_up')
+            self._pending.discard(key)
+
+    def _count(self, outcome):
+        if self.counter is not None:
+            self.counter.inc(outcome)
+
+    def stop(self):
+        """Drop the pending retries and stop the background thread."""
+
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join()
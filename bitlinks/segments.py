@@ -0,0 +1,348 @@
+"""Segmented log of the cache file with a write-behind writer and background compaction.
+
+New bitlinks are not appended to cache.txt itself. Every worker buffers them and appends them in batches
+to the active segment next to it: cache.txt.000001, cache.txt.000002, ...
+A batch is written when flush_entries entries are waiting or the oldest of them has waited flush_interval seconds,
+under an exclusive flock() on cache.txt.lock, so batches of different workers never interleave.
+An entry can carry a written() callback, called by the writer once its batch is on disk: a request
+makes bitlinks under the single-flight lock, and the lock is released by this callback, so a request
+of another worker waiting for it finds the entry (after flush_interval at the latest) while the response is not held up.
+When the active segment grows over segment_size bytes it is sealed (a SEALED line is appended,
+which tells the readers to look for the next segment) and a new one is started.
+
+Sealed segments never change again. Once in a while one worker merges them into cache.txt
+and its sorted index cache.txt.index (see sorted_index.py): the entries of the index and of the sealed segments
+are merged in order (a later bitlink of a channel supersedes an earlier one, duplicates collapse),
+both files are written to temporary files and moved in place with os.replace(), then the merged segments
+are removed and a COMPACTED line in the active segment tells the readers to map the new index.
+Readers see the old files or the new ones, never a half-written file, and both give the same entries
+together with the segments that exist.
+
+Files, in the order their lines apply:
+    cache.txt          - compacted entries, as text (the old single-file cache is read from it once)
+    cache.txt.index    - the same entries, sorted by the hash of the URL, looked up by the workers
+    cache.txt.NNNNNN   - segments, the last one is active"""
+
+import fcntl
+import os
+import threading
+import time
+
+from sorted_index import SortedIndex, key_hash, write_index
+
+#Marker lines in segments: the segment is sealed (its last line), the index has been rebuilt
+SEALED = '#sealed'
+COMPACTED = '#compacted'
+
+#Channels of the old 4-column cache.txt lines, in column order
+LEGACY_CHANNELS = ('telegram', 'vk', 'instagram')
+
+
+def segment_paths(path):
+    """Paths of the segments of the cache file, oldest first."""
+
+    directory, name = os.path.split(os.path.abspath(path))
+    numbers = []
+    for file_name in os.listdir(directory):
+        prefix, _, number = file_name.rpartition('.')
+        if prefix == name and number.isdigit():
+            numbers.append(int(number))
+    return [segment_path(path, number) for number in sorted(numbers)]
+
+
+def segment_path(path, number):
+    return '%s.%06d' % (path, number)
+
+
+def index_path(path):
+    return path + '.index'
+
+
+def segment_number(path):
+    return int(path.rpartition('.')[2])
+
+
+def parse_line(entries, line):
+    """Add a line of a cache file (bytes) to entries {url: {channel: bitlink}}. Returns False for a marker line."""
+
+    new_line = line.decode('utf-8', 'replace').strip().split('\t')
+    if len(new_line) == 3:
+        entries.setdefault(new_line[0], {})[new_line[1]] = new_line[2]
+    elif len(new_line) == 4:
+        entries.setdefault(new_line[0], {}).update(zip(LEGACY_CHANNELS, new_line[1:]))
+    elif new_line[0] in (SEALED, COMPACTED):
+        return False
+    return True
+
+
+def entry_lines(items):
+    """Cache lines of (url, {channel: bitlink}) pairs, each ending with a line break."""
+
+    return ''.join(url + '\t' + channel + '\t' + bitlink + '\n' for url, bitlinks in items for channel, bitlink in bitlinks.items())
+
+
+def append_lines(path, lines):
+    """Append complete lines to a segment with a single write. Must be called under the write lock.
+
+    Readers parse a segment only up to its last line break, so a line that is being written is never read.
+    A line left incomplete by an interrupted write (or the unterminated last line of a segment written
+    before lines ended with a line break) is cut off first, so it is never completed by the next write."""
+
+    data = lines.encode('utf-8')
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b'\n':
+            start = max(0, size - 65536)
+            tail = os.pread(fd, size - start, start)
+            os.ftruncate(fd, start + tail.rfind(b'\n') + 1)
+        if os.write(fd, data) != len(data):
+            raise OSError('Short write to %s' % path)
+    finally:
+        os.close(fd)
+
+
+class _WriteLock:
+    """Exclusive flock() on <cache file>.lock for writing and rolling segments."""
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self._stream = None
+
+    def __enter__(self):
+        self._stream = open(self.path, 'a')
+        fcntl.flock(self._stream, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stream.close()
+        self._stream = None
+
+
+def active_segment(path, segment_size=None):
+    """Path of the active segment, started if there is none or (with segment_size) sealed and rolled if it is full.
+    Must be called under the write lock."""
+
+    segments = segment_paths(path)
+    if segments and (segment_size is None or os.path.getsize(segments[-1]) < segment_size):
+        return segments[-1]
+
+    number = 1
+    if segments:
+        append_lines(segments[-1], SEALED + '\n')
+        number = segment_number(segments[-1]) + 1
+    open(segment_path(path, number), 'a').close()
+    return segment_path(path, number)
+
+
+class CacheWriter:
+    """Write-behind writer of one worker: buffers new entries and appends them to the active segment in batches.
+
+    A background thread writes a batch when flush_entries entries are waiting or after flush_interval seconds,
+    and every compact_interval seconds merges the sealed segments into the cache file (see compact)."""
+
+    def __init__(self, path, flush_entries=100, flush_interval=0.2, segment_size=16 * 2 ** 20, compact_interval=60):
+        self.path = path
+        self.flush_entries = flush_entries
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval
+        self._pending = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self._compacted = time.monotonic()
+
+        with _WriteLock(path):
+            active_segment(path)
+
+    def add(self, url, bitlinks, written=None):
+        """Buffer bitlinks {channel: bitlink} of the URL, they are written by the background thread.
+        written(), if given, is called once they are on disk."""
+
+        with self._condition:
+            self._pending.append((url, dict(bitlinks), written))
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._loop, name='bitlinks-cache-writer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self):
+        """Entries buffered and not written yet."""
+
+        with self._condition:
+            return [(url, bitlinks) for url, bitlinks, _ in self._pending]
+
+    def flush(self):
+        """Write the buffered entries now, with one write to the active segment.
+        If the write fails they stay buffered and are written with the next batch."""
+
+        with self._write_lock:
+            with self._condition:
+                items, self._pending = self._pending, []
+            if not items:
+                return
+            try:
+                with _WriteLock(self.path):
+                    append_lines(active_segment(self.path, self.segment_size),
+                                 entry_lines((url, bitlinks) for url, bitlinks, _ in items))
+            except OSError:
+                with self._condition:
+                    self._pending[:0] = items
+                raise
+        for _, _, written in items:
+            if written is not None:
+                written()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or self._pending, self.compact_interval)
+                #The first entry waits at most flush_interval for others to join its batch
+                if self._pending and not self._stopped:
+                    self._condition.wait_for(lambda: self._stopped or len(self._pending) >= self.flush_entries,
+                                             self.flush_interval)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+                if time.monotonic() - self._compacted >= self.compact_interval:
+                    self._compacted = time.monotonic()
+                    compact(self.path)
+            except OSError:
+                #Disk full or similar: the entries stay buffered, try again after a while
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """Stop the background thread and write what is buffered."""
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def read_entries(path, entries):
+    """Add the lines of a cache file to entries. False if the file does not exist."""
+
+    try:
+        with open(path, 'rb') as in_stream:
+            for line in in_stream:
+                parse_line(entries, line)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def canonical_entries(entries, canonical):
+    """Entries {url: {channel: bitlink}} under the canonical form of their URLs.
+    Entries of equivalent URLs are merged, later ones superseding earlier ones of the same channels."""
+
+    merged = {}
+    for url, bitlinks in entries.items():
+        merged.setdefault(canonical(url), {}).update(bitlinks)
+    return merged
+
+
+def parse_entry(value):
+    """(url, {channel: bitlink}) of the lines of one URL, e.g. a value of the sorted index."""
+
+    entries = {}
+    for line in value.split(b'\n'):
+        parse_line(entries, line)
+    return next(iter(entries.items()))
+
+
+def merge_entries(old, delta):
+    """Yield (hash, url, {channel: bitlink}) of the old index and of the delta {url: {channel: bitlink}}
+    in the order of the index; bitlinks of the delta supersede the old ones of the same channels."""
+
+    new = iter(sorted((key_hash(url), url, bitlinks) for url, bitlinks in delta.items()))
+    pending = next(new, None)
+    for hashed, value in old:
+        url, bitlinks = parse_entry(value)
+        while pending is not None and pending[:2] < (hashed, url):
+            yield pending
+            pending = next(new, None)
+        if pending is not None and pending[:2] == (hashed, url):
+            bitlinks = dict(bitlinks, **pending[2])
+            pending = next(new, None)
+        yield hashed, url, bitlinks
+    if pending is not None:
+        yield pending
+    yield from new
+
+
+def compact(path, rebuild=False, canonical=None, if_missing=False):
+    """Merge the sealed segments into the cache file and its sorted index, without duplicates.
+    Returns the number of merged segments.
+
+    The old index and the sealed segments are merged as streams, so only the segments are held in memory.
+    With rebuild (or without a valid index) the index is made from the cache file instead,
+    and a running compaction is waited for rather than skipped. Then, with canonical(url),
+    the entries are moved to the canonical form of their URLs (old cache files have other forms of them).
+    With if_missing nothing is done if a valid index exists once the lock is taken: workers that start
+    together wait for the first of them to build it and use its index.
+    Only one worker compacts at a time; writers are blocked only while the segments are listed."""
+
+    with open(path + '.compact.lock', 'a') as compact_lock:
+        try:
+            fcntl.flock(compact_lock, fcntl.LOCK_EX | (0 if rebuild else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return 0
+
+        if if_missing:
+            try:
+                SortedIndex(index_path(path))
+                return 0
+            except (FileNotFoundError, ValueError):
+                pass
+
+        with _WriteLock(path):
+            sealed = segment_paths(path)[:-1]
+
+        old = ()
+        delta = {}
+        try:
+            if not rebuild:
+                old = SortedIndex(index_path(path)).items()
+        except (FileNotFoundError, ValueError):
+            rebuild = True
+        if rebuild:
+            read_entries(path, delta)
+        elif not sealed:
+            return 0
+        for file_path in sealed:
+            read_entries(file_path, delta)
+        if rebuild and canonical is not None:
+            delta = canonical_entries(delta, canonical)
+
+        #The cache file and the index are written in one pass, each to a temporary file moved in place when complete
+        with open(path + '.compacting', 'w') as out_stream:
+            def values():
+                for hashed, url, bitlinks in merge_entries(old, delta):
+                    lines = entry_lines([(url, bitlinks)])
+                    out_stream.write(lines)
+                    yield hashed, lines.encode('utf-8')
+
+            write_index(index_path(path) + '.compacting', values())
+            out_stream.flush()
+            os.fsync(out_stream.fileno())
+        os.replace(path + '.compacting', path)
+        os.replace(index_path(path) + '.compacting', index_path(path))
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        for file_path in sealed:
+            os.remove(file_path)
+
+        #Tell the readers to map the new index
+        with _WriteLock(path):
+            append_lines(active_segment(path), COMPACTED + '\n')
+        return len(sealed)
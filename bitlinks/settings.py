@@ -0,0 +1,107 @@
+"""Settings of the web service. Change them before deploying."""
+
+#Cache backend: 'file' (tab-separated cache.txt) or 'sqlite' (WAL database shared by all uwsgi workers)
+CACHE_BACKEND = 'file'
+
+CACHE_FILE = '/change-me/bitlinks/cache.txt'
+CACHE_DB = '/change-me/bitlinks/cache.db'
+
+#'file' backend: new bitlinks are buffered and written in batches of up to CACHE_FLUSH_ENTRIES entries,
+#at the latest CACHE_FLUSH_INTERVAL seconds after the first of them, to segments of about CACHE_SEGMENT_SIZE bytes.
+#Full segments are merged into CACHE_FILE and its sorted index without duplicates, checked every CACHE_COMPACT_INTERVAL
+#seconds; the segments are what every worker parses at startup and keeps in memory besides the shared index
+CACHE_FLUSH_ENTRIES = 100
+CACHE_FLUSH_INTERVAL = 0.2
+CACHE_SEGMENT_SIZE = 16 * 2 ** 20
+CACHE_COMPACT_INTERVAL = 60
+
+#Only pages of this website are shortened (the start of their canonical URL, e.g. 'https://yandex.ru/')
+YOUR_WEBSITE = 'your-website-address'
+
+#Lock files used to let only one uwsgi worker shorten the same URL at a time
+LOCK_DIR = '/change-me/bitlinks/locks'
+
+#Metrics (/bitlinks/metrics): directory of the per-worker snapshots and how often they are written (seconds)
+METRICS_DIR = '/change-me/bitlinks/metrics'
+METRICS_INTERVAL = 1
+
+#Thread pool of each uwsgi worker: number of threads and how many tasks may wait for a free thread
+EXECUTOR_WORKERS = 12
+EXECUTOR_MAX_QUEUE = 48
+
+#Bitly API: access token of the project profile, API address and timeouts in seconds
+BITLY_TOKEN = 'your-bitly-token'
+BITLY_API = 'https://api-ssl.bitly.com'
+BITLY_CONNECT_TIMEOUT = 3
+BITLY_READ_TIMEOUT = 10
+
+#Bitly rate-limit governor, shared by all uwsgi workers (state in BITLY_STATE):
+#calls per second and burst, attempts per call, first backoff delay (seconds, doubled and jittered),
+#longest wait of one call for a token or a retry, failures in a row that open the circuit and its cooldown (seconds)
+BITLY_STATE = '/change-me/bitlinks/locks/bitly.state'
+BITLY_RATE = 5
+BITLY_BURST = 10
+BITLY_ATTEMPTS = 3
+BITLY_BACKOFF = 0.5
+BITLY_MAX_WAIT = 5
+BITLY_BREAKER_FAILURES = 5
+BITLY_BREAKER_COOLDOWN = 30
+
+#Start shortening links while the status of the page is still being checked:
+#the response takes max(check, shorten) instead of check + shorten, at the cost of Bitly calls for missing pages
+SPECULATIVE_SHORTENING = True
+
+#Checking that requested pages exist: total deadline and connect timeout in seconds,
+#how long a result is remembered (seconds) and how many results are remembered
+VALIDATOR_DEADLINE = 5
+VALIDATOR_CONNECT_TIMEOUT = 2
+VALIDATOR_TTL = 300
+VALIDATOR_MAXSIZE = 10000
+
+#Rejected URLs (not our website, missing pages): how long the rejection is remembered (seconds) and how many are kept
+NEGATIVE_TTL = 60
+NEGATIVE_MAXSIZE = 10000
+
+#Batch requests (/bitlinks/batch): URLs per request, URLs shortened at the same time and waiting in the queue
+BATCH_MAX_URLS = 100
+BATCH_CONCURRENCY = 4
+BATCH_MAX_QUEUE = 200
+
+#Streamed /bitlinks/nojs pages: pages made at the same time and waiting in the queue (per worker)
+STREAM_CONCURRENCY = 4
+STREAM_MAX_QUEUE = 16
+
+#Channels whose shortening failed are retried in the background: first delay (seconds, doubled every time) and attempts
+RETRY_DELAY = 5
+RETRY_ATTEMPTS = 5
+
+#Channels (social networks) and UTM tags of their links. Adding a channel makes only its bitlinks,
+#the bitlinks of the other channels are taken from the cache
+CHANNELS = {
+    'telegram': {'utm_source': 'telegram', 'utm_medium': 'social', 'utm_campaign': 'our-channel'},
+    'vk': {'utm_source': 'vk', 'utm_medium': 'social', 'utm_campaign': 'our-public'},
+    'instagram': {'utm_source': 'instagram', 'utm_medium': 'social', 'utm_campaign': 'our-profile'},
+}
+
+#Canonical form of requested URLs: query parameters removed as tracking tags (by name and by name prefix),
+#and whether '/page/' and '/page' are the same page
+TRACKING_PARAMS = ('from', '_openstat', 'fbclid', 'gclid', 'yclid')
+TRACKING_PREFIXES = ('utm_',)
+STRIP_TRAILING_SLASH = False
+
+#Compression of pages and JSON answers: smallest size worth compressing (bytes) and gzip level
+GZIP_MIN_SIZE = 500
+GZIP_LEVEL = 6
+
+#How long browsers may keep a page of cached bitlinks without asking again (seconds).
+#After that they revalidate with If-None-Match and usually get an empty 304 answer
+RESULT_MAX_AGE = 86400
+
+#Byte budget of the loader page: its HTML and the assets it references, as sent with gzip (checked by budget.py)
+LOADER_PAGE_BUDGET = 12288
+
+#Timings of the phases of requests (cache lookup, page status check, Bitly calls, rendering):
+#sent in the Server-Timing header, and written to the log as one JSON line for this share (0 ... 1) of requests.
+#With the header off and no sampling nothing is measured
+SERVER_TIMING = True
+TIMING_LOG_SAMPLE = 0.01
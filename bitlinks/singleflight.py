@@ -0,0 +1,109 @@
+"""Single-flight coalescing of concurrent work for the same key.
+
+When several people open the same link at once, only one request (the leader) checks the page
+and calls https://bitly.com/, the others wait for it and reuse its result.
+
+Inside a worker, threads wait on the leader's in-flight call.
+Between uwsgi workers, the leader holds an exclusive flock() on a lock file; a worker that gets
+the lock after it looks in the cache first, so the leader's result is reused instead of being redone.
+If the result reaches the cache later (a write-behind cache), the leader keeps the lock past its return
+with hold() and releases it once the result is written."""
+
+import fcntl
+import hashlib
+import os
+import threading
+
+
+class _Call:
+    """Work in progress for one key inside this worker."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, in this worker and across all workers.
+
+    Lock files are striped: a key is mapped to one of `stripes` files in `lock_dir`,
+    so the number of files stays fixed however many URLs are requested."""
+
+    def __init__(self, lock_dir, stripes=1024):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._calls = {}
+        self._lock = threading.Lock()
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, work, lookup):
+        """Return lookup() if it has a result, otherwise work(hold), running it only once for concurrent callers.
+
+        lookup() is called after the cross-worker lock is taken and should return None on a miss.
+        hold() keeps the cross-worker lock after work() returns and gives the function that releases it."""
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self._file_lock(key) as file_lock:
+                result = lookup()
+                if result is None:
+                    result = work(file_lock.hold)
+            call.result = result
+            return result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _file_lock(self, key):
+        stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % self.stripes
+        return _FileLock(os.path.join(self.lock_dir, '%04d.lock' % stripe))
+
+
+class _FileLock:
+    """Exclusive flock() on a file, released on exit (unless it is held) or when the worker dies."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._held = False
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def hold(self):
+        """Keep the lock on exit. Returns the function that releases it, from any thread; calls after the first do nothing."""
+
+        self._held = True
+        fd = self._fd
+        released = threading.Lock()
+
+        def release():
+            if released.acquire(blocking=False):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+        return release
+
+    def __exit__(self, *exc_info):
+        if not self._held:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
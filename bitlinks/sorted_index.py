@@ -0,0 +1,97 @@
+"""Sorted index of the compacted cache, mapped into memory read-only by every worker.
+
+The file is written by the compaction (see segments.py) next to the cache file, as cache.txt.index:
+
+    header   - magic, number of entries, offset of the records
+    values   - the cache lines of every URL, as in cache.txt
+    records  - one fixed-size record per URL: 64-bit hash of the URL, offset and length of its lines,
+               sorted by hash (and by URL for equal hashes)
+
+A lookup is a binary search over the records; only the lines of the URL found are parsed (see cache.py).
+Nothing is loaded at startup: the file is shared by all workers through the page cache,
+and a worker opens it in constant time whatever the size of the cache."""
+
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+
+MAGIC = b'BITLINX1'
+HEADER = struct.Struct('<8sQQ')
+RECORD = struct.Struct('<QQI')
+HASH = struct.Struct('<Q')
+
+
+def key_hash(url):
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class SortedIndex:
+    """Read-only view of an index file: values (bytes) by the 64-bit hash of their key.
+    Raises ValueError if the file is not an index."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as in_stream:
+            self.inode = os.fstat(in_stream.fileno()).st_ino
+            self._map = mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise ValueError('%s is not a cache index' % path)
+        magic, self.count, self._records = HEADER.unpack_from(self._map)
+        if magic != MAGIC or self._records + self.count * RECORD.size != len(self._map):
+            raise ValueError('%s is not a cache index' % path)
+
+    def __len__(self):
+        return self.count
+
+    def _hash_at(self, position):
+        return HASH.unpack_from(self._map, self._records + position * RECORD.size)[0]
+
+    def _value_at(self, position):
+        _, offset, length = RECORD.unpack_from(self._map, self._records + position * RECORD.size)
+        return self._map[offset:offset + length]
+
+    def find(self, hashed):
+        """Yield the values stored under the hash (more than one only if keys collide)."""
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._hash_at(middle) < hashed:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count and self._hash_at(low) == hashed:
+            yield self._value_at(low)
+            low += 1
+
+    def items(self):
+        """Yield (hash, value) in the order of the index."""
+
+        for position in range(self.count):
+            yield self._hash_at(position), self._value_at(position)
+
+
+def write_index(path, items):
+    """Write an index of (hash, value) items, given sorted by hash, to path. Returns the number of items.
+    Values are written as they come, the records are collected in a side file and appended at the end."""
+
+    records_path = path + '.records'
+    count = 0
+    with open(path, 'wb') as out_stream, open(records_path, 'w+b') as records:
+        out_stream.write(HEADER.pack(MAGIC, 0, 0))
+        for hashed, value in items:
+            records.write(RECORD.pack(hashed, out_stream.tell(), len(value)))
+            out_stream.write(value)
+            count += 1
+
+        records_offset = out_stream.tell()
+        records.seek(0)
+        shutil.copyfileobj(records, out_stream)
+        out_stream.seek(0)
+        out_stream.write(HEADER.pack(MAGIC, count, records_offset))
+        out_stream.flush()
+        os.fsync(out_stream.fileno())
+    os.remove(records_path)
+    return count
@@ -0,0 +1,105 @@
+"""Timings of the phases of a request: the Server-Timing header and a sampled JSON log line.
+
+A request that is timed gets a Timings object, current in its thread (see start() and current()).
+The phases record their time into it: the cache lookup, the status check of the page,
+the Bitly call of every channel, the rendering of the page. Work done on the thread pools
+gets the Timings object as an argument or through bind().
+
+When neither the header nor the log wants a request, no Timings object is made and every phase
+costs one check for None."""
+
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+#One JSON line per sampled request, written to stderr (the uwsgi log)
+logger = logging.getLogger('bitlinks.timing')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+
+
+class Timings:
+    """Milliseconds spent in every phase of one request. Phases with the same name are added up."""
+
+    def __init__(self, logged=False):
+        self.logged = logged
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds * 1000
+
+    def total(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def header(self):
+        """Value of the Server-Timing header, e.g. 'cache;dur=0.05, status;dur=35.2, total;dur=160.3'."""
+
+        with self._lock:
+            phases = list(self.phases.items())
+        return ', '.join('%s;dur=%.2f' % (name, ms) for name, ms in phases + [('total', self.total())])
+
+    def log(self, **fields):
+        """Write the timings with the fields of the request as one JSON line."""
+
+        with self._lock:
+            phases = {name: round(ms, 2) for name, ms in self.phases.items()}
+        logger.info(json.dumps(dict(fields, ts=round(time.time(), 3), total_ms=round(self.total(), 2), phases_ms=phases)))
+
+
+def start(header, sample):
+    """Start timing the request of this thread if the header is on or it is sampled for the log.
+    Returns the Timings object or None."""
+
+    logged = sample > 0 and (sample >= 1 or random.random() < sample)
+    timings = Timings(logged) if header or logged else None
+    _local.timings = timings
+    return timings
+
+
+def stop():
+    _local.timings = None
+
+
+def current():
+    """Timings of the request of this thread or None."""
+
+    return getattr(_local, 'timings', None)
+
+
+def bind(timings, function):
+    """Function that runs with these timings current in the thread it is called from (e.g. a pool thread)."""
+
+    def bound(*args):
+        _local.timings = timings
+        try:
+            return function(*args)
+        finally:
+            _local.timings = None
+
+    return bound
+
+
+@contextmanager
+def measure(name):
+    """Add the time of the block to the current request, if it is timed."""
+
+    timings = current()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
@@ -0,0 +1,96 @@
+"""Check that a requested page exists (SATUS_CODE == 200 OK) quickly and within a deadline.
+
+A HEAD request is sent first. If the site does not allow HEAD, a GET for the first byte
+(Range: bytes=0-0) is sent and the connection is closed right after the headers, so the page body is never downloaded.
+Connections to each site are kept alive in a pool, and results are remembered for ttl seconds,
+so repeat checks of the same page cost nothing."""
+
+import http.client
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+from cache import TTLCache
+from http_pool import ConnectionPool
+
+#Redirects are followed like urllib.request.urlopen() did, but no further than this
+MAX_REDIRECTS = 5
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class PageValidator:
+    """Returns the status code of a page (0 on connection error or timeout), memoized with a TTL.
+
+    Only definite answers (2xx-4xx) are remembered, errors and 5xx are checked again next time."""
+
+    def __init__(self, deadline=5, connect_timeout=2, pool_size=12, ttl=300, maxsize=10000):
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self.results = TTLCache(ttl, maxsize)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def status(self, url):
+        """Status code of the page: 200 if it exists, 0 if it could not be checked in time."""
+
+        status_code = self.results.get(url)
+        if status_code is not None:
+            return status_code
+
+        try:
+            status_code = self._check(url, time.monotonic() + self.deadline)
+        except (OSError, http.client.HTTPException, ValueError):
+            status_code = 0
+
+        if 200 <= status_code < 500:
+            self.results.set(url, status_code)
+        return status_code
+
+    def _check(self, url, deadline):
+        for redirect in range(MAX_REDIRECTS + 1):
+            status_code, location = self._request('HEAD', url, deadline)
+            if status_code in (405, 501):
+                status_code, location = self._request('GET', url, deadline)
+
+            if status_code not in REDIRECT_CODES or not location:
+                return status_code
+            url = urljoin(url, location)
+
+        return 0
+
+    def _request(self, method, url, deadline):
+        """Send the request and return (status code, Location header). Only the headers are read."""
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('Not an HTTP URL: %s' % url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = {'Connection': 'keep-alive', 'User-Agent': 'Link to Bitlinks with UTM'}
+        if method == 'GET':
+            headers['Range'] = 'bytes=0-0'
+
+        pool = self._pool(parts.scheme, parts.hostname, parts.port)
+
+        #A HEAD response has no body and the connection can be reused, a GET is closed after the headers
+        response, _ = pool.request(method, path, headers, deadline, read_body=method == 'HEAD')
+
+        #The first byte of an existing page is as good as the whole page
+        status_code = 200 if response.status == 206 else response.status
+        return status_code, response.getheader('Location')
+
+    def _pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ConnectionPool(scheme, host, port, self.pool_size, self.connect_timeout, self.deadline)
+            return pool
+
+    def close(self):
+        """Close all pooled connections."""
+
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()